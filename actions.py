@@ -0,0 +1,190 @@
+from logger import logger, SAMPLED
+from global_vars import ACTION_CONCURRENCY, CHANNEL_CONCURRENCY, COSMETIC_CONCURRENCY
+from fanout import FanOutReport, ProgressCallback, with_backoff
+from metrics import METRICS
+from enum import IntEnum
+from typing import Awaitable, Callable, Hashable
+import asyncio
+import discord
+import heapq
+import itertools
+import time
+
+
+class Priority(IntEnum):
+    MOVE = 0
+    ROLE = 1
+    CHANNEL = 2
+    COSMETIC = 3
+
+
+class QueuedAction:
+    def __init__(self, priority: Priority, key: Hashable | None, action: Callable[[], Awaitable]) -> None:
+        self.priority = priority
+        self.key = key
+        self.action = action
+        self.queued_at = time.perf_counter()
+        self.superseded = False
+        # Callers of superseded actions with the same key get the result of this one
+        self.waiters: list[asyncio.Future] = [asyncio.get_running_loop().create_future()]
+
+
+class Lane:
+    def __init__(self, concurrency: int) -> None:
+        self.heap: list[tuple[int, int, QueuedAction]] = []
+        self.concurrency = concurrency
+        self.workers = 0
+        self.paused_until = 0.0
+
+
+class ActionQueue:
+    # Every Discord call with a side effect in a guild goes through its queue. Moves and role
+    # changes run ACTION_CONCURRENCY at a time, moves first. Channel changes have their own
+    # lane of CHANNEL_CONCURRENCY and cosmetic calls one of COSMETIC_CONCURRENCY next to
+    # those, so a move never waits behind a channel set being built or a countdown message.
+    # A queued call with a key is replaced by a later call with the same key, like a move
+    # of a member that is moved again before the first move ran.
+    def __init__(self, guild_id: int) -> None:
+        self.guild_id = guild_id
+        self.urgent = Lane(ACTION_CONCURRENCY)
+        self.channel = Lane(CHANNEL_CONCURRENCY)
+        self.cosmetic = Lane(COSMETIC_CONCURRENCY)
+        self.lanes = (self.urgent, self.channel, self.cosmetic)
+        self.counter = itertools.count()
+        self.queued: dict[Hashable, QueuedAction] = {}
+
+    def __len__(self) -> int:
+        return sum(1 for lane in self.lanes for _, _, queued_action in lane.heap if not queued_action.superseded)
+
+    def lane(self, priority: Priority) -> Lane:
+        if priority == Priority.COSMETIC:
+            return self.cosmetic
+        if priority == Priority.CHANNEL:
+            return self.channel
+        return self.urgent
+
+    def submit(self, priority: Priority, key: Hashable | None, action: Callable[[], Awaitable]) -> asyncio.Future:
+        queued_action = QueuedAction(priority, key, action)
+        previous = self.queued.pop(key, None) if key is not None else None
+        if previous:
+            previous.superseded = True
+            queued_action.waiters.extend(previous.waiters)
+            METRICS.inc('actions_superseded_total', priority=previous.priority.name.lower())
+        if key is not None:
+            self.queued[key] = queued_action
+        lane = self.lane(priority)
+        heapq.heappush(lane.heap, (priority, next(self.counter), queued_action))
+        if lane.workers < lane.concurrency:
+            self.start_workers()
+        return queued_action.waiters[0]
+
+    def pause(self, lane: Lane, seconds: float) -> None:
+        # Discord rate limited a call, nothing new starts in its lane until it may retry.
+        # Rate limits are per route, so the other lanes keep going
+        lane.paused_until = max(lane.paused_until, time.monotonic() + seconds)
+        asyncio.get_running_loop().call_later(seconds, self.start_workers)
+        METRICS.inc('actions_paused_total')
+
+    def next_action(self, lane: Lane) -> QueuedAction | None:
+        while lane.heap and lane.heap[0][2].superseded:
+            heapq.heappop(lane.heap)
+        if not lane.heap or time.monotonic() < lane.paused_until:
+            return None
+        _, _, queued_action = heapq.heappop(lane.heap)
+        if queued_action.key is not None:
+            del self.queued[queued_action.key]
+        return queued_action
+
+    def start_workers(self) -> None:
+        # Workers take actions until their lane is empty or paused and then stop, so an
+        # idle guild has no task at all
+        for lane in self.lanes:
+            while lane.workers < lane.concurrency and lane.workers < len(lane.heap):
+                lane.workers += 1
+                asyncio.get_running_loop().create_task(self.work(lane))
+
+    async def work(self, lane: Lane):
+        try:
+            while (queued_action := self.next_action(lane)) is not None:
+                await self.run(lane, queued_action)
+        finally:
+            lane.workers -= 1
+            if self.idle() and ACTION_QUEUES.get(self.guild_id) is self:
+                del ACTION_QUEUES[self.guild_id]
+
+    def idle(self) -> bool:
+        return not any(lane.workers or lane.heap for lane in self.lanes)
+
+    async def run(self, lane: Lane, queued_action: QueuedAction):
+        METRICS.observe('action_wait_seconds', time.perf_counter() - queued_action.queued_at, priority=queued_action.priority.name.lower())
+        try:
+            result = await with_backoff(queued_action.action, on_retry=lambda seconds: self.pause(lane, seconds))
+        except Exception as e:
+            for waiter in queued_action.waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in queued_action.waiters:
+                if not waiter.done():
+                    waiter.set_result(result)
+
+
+ACTION_QUEUES: dict[int, ActionQueue] = {}
+
+
+def action_queue(guild: discord.Guild) -> ActionQueue:
+    queue = ACTION_QUEUES.get(guild.id)
+    if queue is None:
+        queue = ACTION_QUEUES[guild.id] = ActionQueue(guild.id)
+    return queue
+
+
+def enqueue(guild: discord.Guild, priority: Priority, action: Callable[[], Awaitable], key: Hashable | None = None) -> asyncio.Future:
+    # Awaiting the returned future gives the result of the call or raises its error. The call
+    # may wait behind other work of the guild for longer than Discord waits for an interaction
+    # response, so handlers answer the interaction before they await it
+    return action_queue(guild).submit(priority, key, action)
+
+
+def queued(guild: discord.Guild, priority: Priority, actions: dict[str, Callable[[], Awaitable]]) -> dict[str, Callable[[], Awaitable]]:
+    # Wraps the actions of a fan_out so every one of them goes through the guild's queue
+    return {name: lambda action=action: enqueue(guild, priority, action) for name, action in actions.items()}
+
+
+def rest_call(operation: str, action: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+    async def call():
+        async with METRICS.timed('rest_seconds', operation=operation):
+            return await action()
+    return call
+
+
+async def move_members(moves: list[tuple[discord.Member, discord.VoiceChannel]], on_progress: ProgressCallback | None = None) -> FanOutReport:
+    # The guild's action queue limits how many moves run at once and retries them
+    report = FanOutReport(len(moves))
+    started = time.perf_counter()
+    futures: dict[int, tuple[discord.Member, asyncio.Future]] = {}
+    for member, channel in moves:
+        logger.debug(f'Queueing move of {member.display_name} to {channel.name}', extra=SAMPLED)
+        # Only the last move of a member matters, an earlier one still waiting is dropped
+        futures[member.id] = member, enqueue(member.guild, Priority.MOVE, rest_call('move_to', lambda member=member, channel=channel: member.move_to(channel)), ('move', member.id))
+    # Moves run in the order they were queued, so waiting on them in that order reports
+    # progress as it happens
+    for member, future in futures.values():
+        try:
+            await future
+        except Exception as e:
+            logger.error(f'Moving {member.display_name} failed with error:\n{e}')
+            report.failures[member.display_name] = e
+        report.done += 1
+        if on_progress:
+            await on_progress(report.done, report.total)
+    report.elapsed = time.perf_counter() - started
+    logger.info(report.summary('Moved players'))
+    return report
+
+
+def queue_depths() -> dict:
+    return {(('guild', str(guild_id)),): len(queue) for guild_id, queue in ACTION_QUEUES.items() if len(queue)}
+
+
+METRICS.gauge('action_queue_depth', queue_depths)
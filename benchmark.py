@@ -0,0 +1,234 @@
+from logger import logger
+from fakes import FakeClient, FakeDiscord, FakeGame, FakeInteraction, FakeMessage
+from storage import JsonStorage, SqliteStorage
+from persistence import WRITER
+from classes import GameControls, Timer
+from database import Database, get_database, invalidate_database
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable
+import argparse
+import asyncio
+import database
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import main
+
+# Runs the real handlers against fakes from fakes.py with simulated REST latency and writes
+# the latencies to a JSON report. Compare two reports with --compare to spot regressions:
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+
+PLAYER_COUNTS = [5, 10, 15, 20, 25]
+GUILD_COUNTS = [1, 10, 100, 500]
+
+Scenario = Callable[[FakeDiscord, int, int], Awaitable[list[float]]]
+
+
+async def timed(coroutine: Awaitable) -> float:
+    started = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - started
+
+
+class RunningGame:
+    def __init__(self, game: FakeGame, client: FakeClient) -> None:
+        self.game = game
+        self.client = client
+        self.view = GameControls(game.guild.id, game.storyteller.id)
+        self.database = get_database(game.guild)
+        self.message = FakeMessage(game.game_chat, 'Game commands')
+        self.database.games[game.storyteller.id] = game.game_dict(self.message.id)
+
+    def interaction(self) -> FakeInteraction:
+        return FakeInteraction(self.client, self.game.guild, self.game.storyteller, self.message)
+
+
+def start_games(fake_discord: FakeDiscord, players: int, guilds: int) -> list[RunningGame]:
+    client = FakeClient()
+    return [RunningGame(FakeGame(fake_discord, f'Guild {number}', players), client) for number in range(guilds)]
+
+
+async def bench_day(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    games = start_games(fake_discord, players, guilds)
+    for running_game in games:
+        running_game.game.seat_at_night()
+    latencies = await asyncio.gather(*(timed(running_game.view.day.callback(running_game.interaction())) for running_game in games))
+    for running_game in games:
+        running_game.view.cancel_pending_edits()
+    return latencies
+
+
+async def bench_night(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    games = start_games(fake_discord, players, guilds)
+    for running_game in games:
+        running_game.game.seat_in_town_square()
+    latencies = await asyncio.gather(*(timed(running_game.view.night.callback(running_game.interaction())) for running_game in games))
+    for running_game in games:
+        running_game.view.cancel_pending_edits()
+    return latencies
+
+
+async def bench_timer_expiry(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    games = start_games(fake_discord, players, guilds)
+    timers = []
+    for running_game in games:
+        game = running_game.game
+        game.scatter_over_day_channels()
+        timers.append(Timer(running_game.client, 0, game.game_chat, game.day_category, game.storyteller, game.town_square))
+    return await asyncio.gather(*(timed(timer.finish()) for timer in timers))
+
+
+async def bench_spectators(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    # Every fifth player spectates the storyteller, the latency runs from the storyteller's
+    # move until every spectator followed
+    games = start_games(fake_discord, players, guilds)
+    for running_game in games:
+        game = running_game.game
+        game.guild.on_voice_state_update = main.on_voice_state_update
+        for spectator in game.players[:max(1, players // 5)]:
+            running_game.database.spectators.link(spectator.id, game.storyteller.id)
+            spectator.join(game.town_square)
+    return await asyncio.gather(*(timed(running_game.game.storyteller.move_to(running_game.game.night_channels[0])) for running_game in games))
+
+
+async def bench_database_load(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    games = start_games(fake_discord, players, guilds)
+    await WRITER.flush()
+    latencies = []
+    for running_game in games:
+        started = time.perf_counter()
+        Database(running_game.game.guild)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def bench_database_save(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    # Saving only queues the write, so the sample is the flush that writes every guild at once
+    games = start_games(fake_discord, players, guilds)
+    await WRITER.flush()
+    for running_game in games:
+        running_game.database.save('games', running_game.game.storyteller.id)
+    return [await timed(WRITER.flush())]
+
+
+async def bench_create_game_channels(fake_discord: FakeDiscord, players: int, guilds: int) -> list[float]:
+    games = start_games(fake_discord, players, guilds)
+    return await asyncio.gather(*(timed(main.create_game_channels.callback(running_game.interaction(), players)) for running_game in games))
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "day": bench_day,
+    "night": bench_night,
+    "timer_expiry": bench_timer_expiry,
+    "spectators": bench_spectators,
+    "database_load": bench_database_load,
+    "database_save": bench_database_save,
+    "create_game_channels": bench_create_game_channels,
+}
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_case(name: str, scenario: Scenario, players: int, guilds: int, args: argparse.Namespace) -> dict:
+    fake_discord = FakeDiscord(args.latency, args.jitter)
+    samples = []
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        samples.extend(await scenario(fake_discord, players, guilds))
+        await WRITER.flush()
+        for guild_id in list(database.DATABASES):
+            invalidate_database(guild_id)
+    result = {
+        "scenario": name,
+        "players": players,
+        "guilds": guilds,
+        "samples": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "max_ms": max(samples) * 1000,
+        "wall_s": time.perf_counter() - started,
+        "rest_calls": {operation: count / args.repeat for operation, count in sorted(fake_discord.calls.items())},
+    }
+    print(f'{name:<22} players={players:<3} guilds={guilds:<4} p50={result["p50_ms"]:8.1f}ms p95={result["p95_ms"]:8.1f}ms max={result["max_ms"]:8.1f}ms')
+    return result
+
+
+def git_version() -> str | None:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_report: dict, new_report: dict) -> None:
+    old_results = {(result["scenario"], result["players"], result["guilds"]): result for result in old_report["results"]}
+    print(f'\nCompared to {old_report.get("version")} from {old_report.get("created_at")}:')
+    for result in new_report["results"]:
+        old = old_results.get((result["scenario"], result["players"], result["guilds"]))
+        if old is None or not old["p95_ms"]:
+            continue
+        change = (result["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+        print(f'{result["scenario"]:<22} players={result["players"]:<3} guilds={result["guilds"]:<4} p95 {old["p95_ms"]:8.1f}ms -> {result["p95_ms"]:8.1f}ms ({change:+.0f}%)')
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # Never touch the real databases
+        if args.storage == 'sqlite':
+            database.STORAGE = SqliteStorage(Path(directory) / 'benchmark.sqlite3')
+        else:
+            database.STORAGE = JsonStorage(Path(directory))
+        for name in args.scenarios:
+            for players in args.players:
+                for guilds in args.guilds:
+                    results.append(await run_case(name, SCENARIOS[name], players, guilds, args))
+        await WRITER.close()
+    return {
+        "version": git_version(),
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "settings": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "repeat": args.repeat,
+            "storage": args.storage,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks the bot against fake guilds with simulated Discord latency')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--players', nargs='+', type=int, default=PLAYER_COUNTS)
+    parser.add_argument('--guilds', nargs='+', type=int, default=GUILD_COUNTS)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every fake Discord call takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many seconds are added to every call at random')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--output', type=Path, default=Path('benchmark.json'))
+    parser.add_argument('--compare', type=Path, help='Earlier report to compare the p95 latencies with')
+    parser.add_argument('--verbose', action='store_true', help='Keep the bot logging at its normal level')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    args.output.write_text(json.dumps(report, indent=4))
+    print(f'Wrote {len(report["results"])} results to {args.output}')
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report)
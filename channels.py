@@ -0,0 +1,155 @@
+from logger import logger
+from global_vars import CHANNEL_CONCURRENCY
+from fanout import FanOutReport, ProgressCallback, fan_out
+from actions import Priority, enqueue, queued, rest_call
+from utils import pick_random_channel_names
+from roles import role_index
+from database import Database, get_database
+import asyncio
+import discord
+import time
+
+
+class ChannelPlan:
+    def __init__(self, owner_name: str, amount_of_players: int) -> None:
+        self.day_category_name = f"{owner_name}'s Game"
+        self.night_category_name = f"{owner_name}'s Night"
+        self.day_channel_names = pick_random_channel_names(10)
+        self.day_channel_names.append(f"Town Square ({owner_name}'s game)")
+        self.night_channel_names = pick_random_channel_names(amount_of_players)
+        logger.debug(f'Picked the following random day channel names:\n{self.day_channel_names}')
+        logger.debug(f'Picked the following random night channel names:\n{self.night_channel_names}')
+
+    @property
+    def channel_count(self) -> int:
+        # Both categories, every voice channel and game-chat
+        return 2 + len(self.day_channel_names) + len(self.night_channel_names) + 1
+
+    def to_dict(self) -> dict[str, list[str]]:
+        return {
+            self.day_category_name: self.day_channel_names + ['game-chat'],
+            self.night_category_name: self.night_channel_names
+        }
+
+
+class ProvisioningError(Exception):
+    def __init__(self, failures: dict[str, Exception]) -> None:
+        super().__init__(f'Could not create {", ".join(failures)}')
+        self.failures = failures
+
+
+def day_overwrites(guild: discord.Guild) -> dict:
+    return {role_index(guild).named('BotC-bot'): discord.PermissionOverwrite(view_channel=True, manage_channels=True)}
+
+
+def night_overwrites(guild: discord.Guild) -> dict:
+    roles = role_index(guild)
+    return {
+        guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        roles.storyteller(get_database(guild).storyteller_role_id): discord.PermissionOverwrite(view_channel=True, manage_channels=True),
+        roles.named('BotC-bot'): discord.PermissionOverwrite(view_channel=True, manage_channels=True),
+        roles.named('Admin'): discord.PermissionOverwrite(view_channel=True, manage_channels=True)
+    }
+
+
+async def rollback(guild: discord.Guild, channels: list[discord.abc.GuildChannel]) -> None:
+    logger.warning(f'Rolling back {len(channels)} created channels')
+    # Channels first so no category is deleted while it still has children
+    categories = [channel for channel in channels if isinstance(channel, discord.CategoryChannel)]
+    children = [channel for channel in channels if not isinstance(channel, discord.CategoryChannel)]
+    for batch in (children, categories):
+        actions = {f'delete {channel.name}': rest_call('delete_channel', channel.delete) for channel in batch}
+        await fan_out(queued(guild, Priority.CHANNEL, actions), CHANNEL_CONCURRENCY, retries=0)
+
+
+async def provision_game_channels(guild: discord.Guild, plan: ChannelPlan, on_progress: ProgressCallback | None = None) -> tuple[discord.CategoryChannel, discord.CategoryChannel, float]:
+    started = time.perf_counter()
+    created: list[discord.abc.GuildChannel] = []
+    done = 0
+
+    async def progress(report_done: int, total: int):
+        if on_progress:
+            await on_progress(done + report_done, plan.channel_count)
+
+    def create(operation: str, create_channel, *args, **kwargs) -> asyncio.Future:
+        return enqueue(guild, Priority.CHANNEL, rest_call(operation, lambda: create_channel(*args, **kwargs)))
+
+    day_overwrite = day_overwrites(guild)
+    night_overwrite = night_overwrites(guild)
+    categories = await asyncio.gather(
+        create('create_category', guild.create_category, plan.day_category_name, overwrites=day_overwrite),
+        create('create_category', guild.create_category, plan.night_category_name, overwrites=night_overwrite),
+        return_exceptions=True)
+    created.extend(category for category in categories if not isinstance(category, BaseException))
+    failures = {name: category for name, category in zip(plan.to_dict(), categories) if isinstance(category, BaseException)}
+    if failures:
+        await rollback(guild, created)
+        raise ProvisioningError(failures)
+    day_category, night_category = categories
+    done = 2
+    logger.info(f"Created {day_category.name} and {night_category.name} on {guild.name}")
+
+    actions = {}
+    for position, channel_name in enumerate(plan.day_channel_names):
+        actions[f'{day_category.name}/{channel_name}'] = lambda name=channel_name, position=position: create('create_voice_channel', day_category.create_voice_channel, name, overwrites=day_overwrite, position=position)
+    actions[f'{day_category.name}/game-chat'] = lambda: create('create_text_channel', day_category.create_text_channel, 'game-chat', overwrites=day_overwrite)
+    for position, channel_name in enumerate(plan.night_channel_names):
+        actions[f'{night_category.name}/{channel_name}'] = lambda name=channel_name, position=position: create('create_voice_channel', night_category.create_voice_channel, name, overwrites=night_overwrite, position=position)
+    report: FanOutReport = await fan_out(actions, CHANNEL_CONCURRENCY, progress, retries=0)
+    created.extend(report.results.values())
+    if report.failures:
+        await rollback(guild, created)
+        raise ProvisioningError(report.failures)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f'Created {plan.channel_count} channels for {day_category.name} and {night_category.name} in {elapsed:.2f}s')
+    return day_category, night_category, elapsed
+
+
+async def delete_channels(database: Database, categories: list[discord.CategoryChannel], extra_channels: list[discord.abc.GuildChannel] = (), on_progress: ProgressCallback | None = None) -> FanOutReport:
+    # Every channel is written to the pending_deletions journal before anything is deleted and
+    # taken off when it is gone, so a restart halfway through can pick up where it stopped
+    children = [channel for category in categories for channel in category.channels] + list(extra_channels)
+    journal = database.dict.setdefault("pending_deletions", [])
+    journal.extend(channel.id for channel in children + categories if channel.id not in journal)
+    database.save('meta', 'pending_deletions')
+    report = FanOutReport(len(children) + len(categories))
+    started = time.perf_counter()
+
+    async def delete(channel: discord.abc.GuildChannel):
+        try:
+            await enqueue(database.guild, Priority.CHANNEL, rest_call('delete_channel', channel.delete), ('delete', channel.id))
+        except discord.NotFound:
+            pass
+        # A second deletion of the same channel running at the same time already took it off
+        if channel.id in journal:
+            journal.remove(channel.id)
+            database.save('meta', 'pending_deletions')
+
+    async def progress(done: int, total: int):
+        if on_progress:
+            await on_progress(report.done + done, report.total)
+
+    for batch in (children, categories):
+        actions = {f'{getattr(channel.category, "name", database.guild_name)}/{channel.name}': lambda channel=channel: delete(channel) for channel in batch}
+        batch_report = await fan_out(actions, CHANNEL_CONCURRENCY, progress, retries=0)
+        report.done += batch_report.done
+        report.failures.update(batch_report.failures)
+        if report.failures:
+            # Categories that still have children are left for the next attempt
+            break
+    report.elapsed = time.perf_counter() - started
+    logger.info(report.summary(f'Deleted channels on {database.guild_name}'))
+    return report
+
+
+async def resume_pending_deletions(database: Database) -> None:
+    journal = database.dict.get("pending_deletions")
+    if not journal:
+        return
+    channels = [database.guild.get_channel(channel_id) for channel_id in journal]
+    journal[:] = [channel.id for channel in channels if channel is not None]
+    logger.info(f'Resuming deletion of {len(journal)} channels on {database.guild_name}')
+    categories = [channel for channel in channels if isinstance(channel, discord.CategoryChannel)]
+    others = [channel for channel in channels if channel is not None and not isinstance(channel, discord.CategoryChannel)]
+    await delete_channels(database, categories, [channel for channel in others if channel.category not in categories])
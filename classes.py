@@ -1,182 +1,417 @@
-from logger import logger
+from logger import logger, SAMPLED
 import discord
 import asyncio
 import time
-from utils import is_owner
+from collections import Counter
+from utils import VIEW_OWNERS, is_owner
 from discord import app_commands
-from database import Database
-from global_vars import TIMERS
+from database import DATABASES, get_database
+from global_vars import VIEW_EDIT_INTERVAL, TRANSIENT_LABEL_DURATION, TIMER_UPDATE_INTERVALS, TIMER_FINAL_MESSAGE_DURATION, METRICS_HOST, METRICS_PORT, SHARD_HEALTH_INTERVAL, SHARD_LATENCY_WARNING
+from persistence import WRITER
+from metrics import METRICS, instrumented, serve_metrics
+from fanout import FanOutReport
+from actions import Priority, enqueue, move_members, rest_call
+from scheduler import Scheduler, ScheduledCall
+from pool import release_game_channels
 
 
 class Timer:
-    def __init__(self, time_to_sleep: int, channel_to_notify: discord.TextChannel, day_category: discord.CategoryChannel, user_to_ignore: discord.User, channel_to_move_to: discord.VoiceChannel) -> None:
+    def __init__(self, client: 'MyClient', time_to_sleep: int, channel_to_notify: discord.TextChannel, day_category: discord.CategoryChannel, user_to_ignore: discord.User, channel_to_move_to: discord.VoiceChannel) -> None:
+        self.scheduler = client.scheduler
+        self.timers = client.timers
+        self.key = (channel_to_notify.guild.id, user_to_ignore.id)
         self.time_to_sleep = time_to_sleep
+        self.deadline = None
+        self.call: ScheduledCall | None = None
         self.cancelled = False
         self.channel_to_notify = channel_to_notify
         self.day_category = day_category
         self.user_to_ignore = user_to_ignore
         self.channel_to_move_to = channel_to_move_to
+        # The single countdown message, sent on the first update and edited after that
+        self.message: discord.Message | None = None
+        self.timers[self.key] = self
+
+    @property
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    async def start(self):
+        self.deadline = time.monotonic() + self.time_to_sleep
+        await self.notify()
+
+    def schedule_next(self):
+        # Next update is at the next multiple of the interval for the time left
+        seconds_left = round(self.remaining) - 1
+        interval = next((interval for threshold, interval in TIMER_UPDATE_INTERVALS if seconds_left > threshold), TIMER_UPDATE_INTERVALS[-1][1])
+        next_mark = seconds_left // interval * interval
+        if next_mark <= 0:
+            self.call = self.scheduler.call_at(self.deadline, self.finish)
+            return
+        self.call = self.scheduler.call_at(self.deadline - next_mark, self.notify)
+
+    def show(self, content: str, **kwargs) -> asyncio.Future:
+        guild = self.channel_to_notify.guild
+        if self.message is None:
+            send = lambda: self.channel_to_notify.send(content=content, **kwargs)
+            return enqueue(guild, Priority.COSMETIC, rest_call('send_message', send), ('countdown', self.channel_to_notify.id))
+        message = self.message
+        edit = lambda: message.edit(content=content, **kwargs)
+        # An update still waiting for its turn is replaced by this one
+        return enqueue(guild, Priority.COSMETIC, rest_call('edit_message', edit), ('countdown', self.channel_to_notify.id))
+
+    async def notify(self):
+        remaining = round(self.remaining)
+        self.schedule_next()
+        logger.info(f'Updating countdown in {self.channel_to_notify.name}, {remaining} seconds left', extra=SAMPLED)
+        left = f'{remaining / 60:.1f} minutes' if remaining >= 60 else f'{remaining} seconds'
+        sent = self.message is None
+        try:
+            message = await self.show(f'You have {left} before voting!')
+        except discord.NotFound:
+            # Someone deleted the countdown message, the next update sends a new one
+            self.message = None
+            return
+        if sent:
+            self.message = message
+            if self.timers.get(self.key) is not self:
+                # The timer ended while the message was on its way
+                await enqueue(self.channel_to_notify.guild, Priority.COSMETIC, rest_call('delete_message', message.delete))
 
-    async def run(self):
-        while self.time_to_sleep > 0 and not self.cancelled:
-            logger.info(f'Sleeping for another second... {self.time_to_sleep} left')
-            if self.time_to_sleep % 30 == 0:
-                logger.info(f'Notifing {self.channel_to_notify.name}')
-                await self.channel_to_notify.send(content=f'You have {self.time_to_sleep / 60:.1f} minutes before voting!', delete_after=30)
-            await asyncio.sleep(1)
-            self.time_to_sleep -= 1
-        await self.finish()
-    
     async def cancel(self):
         self.cancelled = True
-        await self.channel_to_notify.send(content=f'Timer was cancelled!', delete_after=10)
+        self.call.cancel()
+        self.timers.pop(self.key, None)
+        if self.message is not None:
+            try:
+                await self.show('Timer was cancelled!', delete_after=10)
+            except discord.HTTPException as e:
+                logger.error(f'Could not update countdown in {self.channel_to_notify.name}:\n{e}')
         logger.warning(f'Timer was cancelled!')
 
     async def finish(self):
         if self.cancelled:
             return
-        for channel in self.day_category.voice_channels:
-            if channel == self.channel_to_move_to:
-                continue
-            for member in channel.members:
-                if member == self.user_to_ignore:
-                    continue
-                await member.move_to(self.channel_to_move_to)
-        TIMERS.pop(self.user_to_ignore.display_name)
+        self.timers.pop(self.key, None)
+        # Cosmetic calls have their own lane, the moves never wait for this edit
+        final = self.show('Voting now!', delete_after=TIMER_FINAL_MESSAGE_DURATION) if self.message is not None else None
+        moves = [
+            (member, self.channel_to_move_to)
+            for channel in self.day_category.voice_channels if channel != self.channel_to_move_to
+            for member in channel.members if member != self.user_to_ignore
+        ]
+        await move_members(moves)
+        if final is not None:
+            try:
+                await final
+            except discord.HTTPException as e:
+                logger.error(f'Could not update countdown in {self.channel_to_notify.name}:\n{e}')
 
 class GameControls(discord.ui.View):
+    # A persistent view, the custom_ids only depend on the guild and the storyteller so
+    # MyClient.add_view can hook a new instance up to the stored message after a restart
+    ITEM_NAMES = ('day', 'night', 'cancel_timer', 'quit', 'timer')
+
+    def __init__(self, guild_id: int, owner_id: int):
+        super().__init__(timeout=None)
+        self.guild_id = guild_id
+        self.owner_id = owner_id
+        for name in self.ITEM_NAMES:
+            custom_id = self.custom_id(name, guild_id, owner_id)
+            getattr(self, name).custom_id = custom_id
+            VIEW_OWNERS[custom_id] = (guild_id, owner_id)
+        self.default_labels = {item.custom_id: item.label for item in self.children if isinstance(item, discord.ui.Button)}
+        self.reverts: dict[str, ScheduledCall] = {}
+        self.pending_edit: dict | None = None
+        self.pending_edit_call: ScheduledCall | None = None
+        self.edit_interaction: discord.Interaction | None = None
+
+    @staticmethod
+    def custom_id(name: str, guild_id: int, owner_id: int) -> str:
+        return f'botc:{name}:{guild_id}:{owner_id}'
+
+    @classmethod
+    def forget(cls, guild_id: int, owner_id: int):
+        # Clicks on the panel of an ended game are no longer accepted
+        for name in cls.ITEM_NAMES:
+            VIEW_OWNERS.pop(cls.custom_id(name, guild_id, owner_id), None)
+
+    def request_edit(self, interaction: discord.Interaction, **kwargs):
+        # Edits requested within VIEW_EDIT_INTERVAL of each other are sent as one message edit
+        self.edit_interaction = interaction
+        if self.pending_edit is None:
+            self.pending_edit = {}
+            self.pending_edit_call = interaction.client.scheduler.call_later(VIEW_EDIT_INTERVAL, self.flush_edit)
+        self.pending_edit.update(kwargs)
+
+    async def flush_edit(self):
+        kwargs, self.pending_edit = self.pending_edit, None
+        interaction = self.edit_interaction
+        edit = lambda: interaction.followup.edit_message(interaction.message.id, view=self, **kwargs)
+        # An edit that changes the same fields replaces one that is still queued
+        await enqueue(interaction.guild, Priority.COSMETIC, rest_call('edit_message', edit), ('edit', interaction.message.id, tuple(sorted(kwargs))))
+
+    def cancel_pending_edits(self):
+        if self.pending_edit_call:
+            self.pending_edit_call.cancel()
+        self.pending_edit = None
+        for revert in self.reverts.values():
+            revert.cancel()
+        self.reverts.clear()
+
+    async def flash(self, interaction: discord.Interaction, button: discord.ui.Button, label: str, duration: float = TRANSIENT_LABEL_DURATION):
+        previous_revert = self.reverts.pop(button.custom_id, None)
+        if previous_revert:
+            previous_revert.cancel()
+        button.label = label
+        await interaction.response.edit_message(view=self)
+        self.reverts[button.custom_id] = interaction.client.scheduler.call_later(duration, lambda: self.reset_label(interaction, button))
+
+    def reset_label(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.reverts.pop(button.custom_id, None)
+        button.label = self.default_labels[button.custom_id]
+        self.request_edit(interaction)
+
+    def progress_reporter(self, interaction: discord.Interaction, button: discord.ui.Button):
+        async def report_progress(done: int, total: int):
+            button.label = f'Moving players... {done}/{total}'
+            self.request_edit(interaction)
+
+        return report_progress
+
+    def finish_moving(self, interaction: discord.Interaction, button: discord.ui.Button, game_owner: str, report: FanOutReport):
+        label = self.default_labels[button.custom_id]
+        button.label = label
+        self.request_edit(interaction, content=f"Game commands for {game_owner}'s game\n{label}: {report.summary('moved players')}")
 
     @discord.ui.button(label='Day', style=discord.ButtonStyle.success)
+    @instrumented('button.day')
     async def day(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if not is_owner(interaction, button.view.id):
+        if not is_owner(interaction, button.custom_id):
             return
         guild = interaction.guild
-        database = Database(guild)
+        database = get_database(guild)
         game_owner = interaction.user.display_name
         logger.info(f"{game_owner} clicked Day button")
-        game: dict = database.games[game_owner]
+        game: dict = database.games[interaction.user.id]
         button.label = 'Moving players...'
         await interaction.response.edit_message(view=self)
         town_square_channel = guild.get_channel(game["town_square_channel"][0])
         night_category = guild.get_channel(game["night_category"][0])
         logger.info(f'Moving players from {night_category.name} to {town_square_channel.name}')
-        for channel in night_category.voice_channels:
-            channel_name = channel.name
-            if channel_name == town_square_channel.name:
-                continue
-            for member in channel.members:
-                if member.display_name == game_owner:
-                    continue
-                await member.move_to(town_square_channel)
-                logger.info(f'Moved {member.display_name} to {town_square_channel.name}')
-
-        button.label = 'Day'
-        await interaction.followup.edit_message(interaction.message.id, view=self)
+        moves = [
+            (member, town_square_channel)
+            for channel in night_category.voice_channels if channel.name != town_square_channel.name
+            for member in channel.members if member.id != interaction.user.id
+        ]
+        report = await move_members(moves, self.progress_reporter(interaction, button))
+        self.finish_moving(interaction, button, game_owner, report)
 
     @discord.ui.button(label='Night', style=discord.ButtonStyle.gray)
+    @instrumented('button.night')
     async def night(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if not is_owner(interaction, button.view.id):
+        if not is_owner(interaction, button.custom_id):
             return
         game_owner = interaction.user.display_name
         logger.info(f'{game_owner} clicked Night button')
         guild = interaction.guild
-        database = Database(guild)
-        game = database.games[game_owner]
+        database = get_database(guild)
+        game = database.games[interaction.user.id]
         button.label = 'Moving players...'
         await interaction.response.edit_message(view=self)
         town_square_channel = guild.get_channel(game["town_square_channel"][0])
         night_category = guild.get_channel(game["night_category"][0])
         night_channels = [channel for channel in night_category.voice_channels]
         logger.info(f'Moving players from {town_square_channel.name} to random channels in {night_category.name}')
+        moves = []
         for member in town_square_channel.members:
-            if member.display_name == game_owner:
+            if member.id == interaction.user.id:
                 continue
-            channel_to_move_to = night_channels.pop(0)
-            await member.move_to(channel_to_move_to)
-            logger.info(f'Moved {member.display_name} to {channel_to_move_to.name}')
-
-        button.label = 'Night'
-        await interaction.followup.edit_message(interaction.message.id, view=self)
+            if not night_channels:
+                logger.warning(f'Not enough channels in {night_category.name} for {member.display_name}, leaving them in {town_square_channel.name}')
+                continue
+            moves.append((member, night_channels.pop(0)))
+        report = await move_members(moves, self.progress_reporter(interaction, button))
+        self.finish_moving(interaction, button, game_owner, report)
 
     @discord.ui.button(label='Cancel timer', style=discord.ButtonStyle.red)
+    @instrumented('button.cancel_timer')
     async def cancel_timer(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_view = button.view
-        if not is_owner(interaction, button_view.id):
+        if not is_owner(interaction, button.custom_id):
             return
         game_owner = interaction.user.display_name
         logger.info(f'{game_owner} clicked Cancel timer button')
         guild = interaction.guild
-        database = Database(guild)
-        timer: Timer = TIMERS.get(game_owner)
+        timer: Timer = interaction.client.timers.get((guild.id, interaction.user.id))
         if not timer:
-            button.label = 'No timer found!'
-            await interaction.response.edit_message(view=self)
+            await self.flash(interaction, button, 'No timer found!')
             logger.warning(f'No timer found for {game_owner}')
-            time.sleep(3)
-            button.label = 'Cancel timer'
-            await interaction.followup.edit_message(interaction.message.id, view=self)
             return
-        button.label = 'Timer cancelled!'
-        await interaction.response.edit_message(view=self)
+        await self.flash(interaction, button, 'Timer cancelled!')
         await timer.cancel()
-        TIMERS.pop(game_owner)
-        time.sleep(3)
-        button.label = 'Cancel timer'
-        await interaction.followup.edit_message(interaction.message.id, view=self)
-        
 
     @discord.ui.button(label='Quit game', style=discord.ButtonStyle.red)
+    @instrumented('button.quit')
     async def quit(self, interaction: discord.Interaction, button: discord.ui.Button):
         button_view = button.view
-        if not is_owner(interaction, button_view.id):
+        if not is_owner(interaction, button.custom_id):
             return
         game_owner = interaction.user
         game_owner_name = game_owner.display_name
         logger.info(f'{game_owner_name} clicked Quit game')
         guild = interaction.guild
-        database = Database(guild)
+        database = get_database(guild)
         storyteller_role = guild.get_role(database.storyteller_role_id)
+        self.cancel_pending_edits()
+        self.forget(guild.id, game_owner.id)
+        self.stop()
+        button_view.clear_items()
+        game = database.games.pop(game_owner.id)
+        database.save('games', game_owner.id)
+        interaction.client.scheduler.call_later(0, lambda: release_game_channels(guild, game))
+        await interaction.response.edit_message(content='Game ended', view=self, delete_after=10)
         try:
             logger.info(f'Attempting to remove storyteller role from {game_owner_name}')
-            await game_owner.remove_roles(storyteller_role)
+            remove_role = rest_call('remove_roles', lambda: game_owner.remove_roles(storyteller_role))
+            await enqueue(guild, Priority.ROLE, remove_role, ('roles', game_owner.id, storyteller_role.id))
             logger.info(f'Successfully removed storyteller role from {game_owner_name}')
         except discord.errors.Forbidden:
             logger.error(f'Could not remove storyteller role from {game_owner_name} because user probably has higher privileges')
-        button_view.clear_items()
-        database.games.pop(game_owner_name)
-        database.save()
-        await interaction.response.edit_message(content='Game ended', view=self, delete_after=10)
         logger.info(f'{game_owner_name} game ended successfully')
 
     @discord.ui.select(min_values=1, max_values=1, options=[discord.SelectOption(label=f'{i*0.5} minutes') for i in range(4,27)], placeholder='Select time players have until vote')
+    @instrumented('select.timer')
     async def timer(self, interaction: discord.Interaction, select: discord.ui.Select):
         select_view: discord.ui.View = select.view
-        if not is_owner(interaction, select_view.id):
+        if not is_owner(interaction, select.custom_id):
             return
         game_owner = interaction.user
         game_owner_name = game_owner.display_name
-        if game_owner_name in TIMERS:
+        guild = interaction.guild
+        if (guild.id, game_owner.id) in interaction.client.timers:
             logger.warning(f'{game_owner_name} already has a running timer!')
             await interaction.response.send_message(f'You already have a running timer! Cancel that one first!', ephemeral=True, delete_after=10)
             return
-        guild = interaction.guild
         selected_value = select.values[0]
         logger.info(f"{game_owner_name} started a timer of {selected_value} minutes")
         time_to_sleep = float(selected_value.replace(' minutes', '')) * 60
         logger.info(f"I got {time_to_sleep:.2f} seconds to sleep")
-        database = Database(guild)
-        game = database.games[game_owner_name]
+        database = get_database(guild)
+        game = database.games[game_owner.id]
         await interaction.response.send_message(f'Will return players to Town Square after {selected_value} minutes', ephemeral=True, delete_after=10)
-        timer = Timer(time_to_sleep, guild.get_channel(game["game_chat_channel"][0]), guild.get_channel(game["day_category"][0]), game_owner, guild.get_channel(game["town_square_channel"][0]))
-        TIMERS[game_owner_name] = timer
+        timer = Timer(interaction.client, time_to_sleep, guild.get_channel(game["game_chat_channel"][0]), guild.get_channel(game["day_category"][0]), game_owner, guild.get_channel(game["town_square_channel"][0]))
         children = select_view.children
         for child in children:
             if isinstance(child, discord.ui.Select):
                 child.placeholder = 'Select time players have until vote'
-                await interaction.followup.edit_message(interaction.message.id, view=select_view)
-        await timer.run()
+        self.request_edit(interaction)
+        await timer.start()
             
-class MyClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents):
-        super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
+class InstrumentedTree(app_commands.CommandTree):
+    # Times every slash command from the moment it passes the tree until its callback is done
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+    def record(self, interaction: discord.Interaction, command_name: str):
+        started = interaction.extras.get('started')
+        if started is not None:
+            METRICS.observe('handler_seconds', time.perf_counter() - started, handler=f'/{command_name}')
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        command_name = interaction.command.qualified_name if interaction.command else 'unknown'
+        self.record(interaction, command_name)
+        METRICS.inc('handler_seconds_errors_total', handler=f'/{command_name}')
+        await super().on_error(interaction, error)
+
+
+class ClientMixin:
+    # Everything the bot keeps on its client, shared by MyClient and MyShardedClient.
+    # All state is per guild and Discord sends a guild's events to a single shard, so
+    # shard processes never share a guild, its timers or its database.
+    def __init__(self, *, intents: discord.Intents, **options):
+        super().__init__(intents=intents, **options)
+        self.tree = InstrumentedTree(self)
+        self.scheduler = Scheduler()
+        self.timers: dict[tuple[int, int], Timer] = {}
+        self.voice_event_counts = Counter(filtered=0, handled=0)
+        self.ready_guilds: set[int] = set()
+        self.shards_connected: dict[int, bool] = {}
+        self.metrics_server: asyncio.AbstractServer | None = None
+        METRICS.gauge('voice_events_total', lambda: {(('result', result),): count for result, count in self.voice_event_counts.items()})
+        METRICS.gauge('write_behind_queue_depth', lambda: WRITER.queue_depth)
+        METRICS.gauge('write_behind_last_flush_seconds', lambda: WRITER.last_flush_latency)
+        METRICS.gauge('scheduled_calls', lambda: len(self.scheduler))
+        METRICS.gauge('running_timers', lambda: len(self.timers))
+        METRICS.gauge('cached_databases', lambda: len(DATABASES))
+        METRICS.gauge('ready_guilds', lambda: len(self.ready_guilds))
+        METRICS.gauge('shard_latency_seconds', lambda: {(('shard', str(shard_id)),): latency for shard_id, latency in self.shard_latencies()})
+        METRICS.gauge('shard_connected', lambda: {(('shard', str(shard_id)),): int(connected) for shard_id, connected in self.shards_connected.items()})
+        METRICS.gauge('shard_guilds', lambda: {(('shard', str(shard_id)),): count for shard_id, count in Counter(guild.shard_id for guild in self.guilds).items()})
+
+    def shard_latencies(self) -> list[tuple[int, float]]:
+        return [(self.shard_id or 0, self.latency)]
+
+    async def setup_hook(self):
+        self.scheduler.call_later(SHARD_HEALTH_INTERVAL, self.check_shard_health)
+        if METRICS_PORT is None:
+            return
+        try:
+            self.metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f'Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}, /stats still works:\n{e}')
+
+    def check_shard_health(self):
+        self.scheduler.call_later(SHARD_HEALTH_INTERVAL, self.check_shard_health)
+        for shard_id, latency in self.shard_latencies():
+            if not self.shards_connected.get(shard_id):
+                logger.warning(f'Shard {shard_id} is not connected')
+            elif latency > SHARD_LATENCY_WARNING:
+                logger.warning(f'Shard {shard_id} heartbeat latency is {latency * 1000:.0f}ms')
+
+    def record_shard_event(self, shard_id: int, event: str):
+        METRICS.inc('shard_events_total', shard=shard_id, event=event)
+        self.shards_connected[shard_id] = event != 'disconnect'
+        if event == 'disconnect':
+            logger.warning(f'Shard {shard_id} disconnected')
+            return
+        logger.info(f'Shard {shard_id} {event}')
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command: app_commands.Command | app_commands.ContextMenu):
+        self.tree.record(interaction, command.qualified_name)
+
+    async def close(self):
+        logger.info(f'Flushing {WRITER.queue_depth} pending database writes before shutting down')
+        await WRITER.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        await super().close()
+
+
+class MyClient(ClientMixin, discord.Client):
+    async def on_connect(self):
+        self.record_shard_event(self.shard_id or 0, 'connected')
+
+    async def on_disconnect(self):
+        self.record_shard_event(self.shard_id or 0, 'disconnect')
+
+    async def on_resumed(self):
+        self.record_shard_event(self.shard_id or 0, 'resumed')
+
+
+class MyShardedClient(ClientMixin, discord.AutoShardedClient):
+    # Runs the shards in shard_ids out of shard_count in this process, see launcher.py
+    def shard_latencies(self) -> list[tuple[int, float]]:
+        return self.latencies
+
+    async def on_shard_connect(self, shard_id: int):
+        self.record_shard_event(shard_id, 'connected')
+
+    async def on_shard_disconnect(self, shard_id: int):
+        self.record_shard_event(shard_id, 'disconnect')
+
+    async def on_shard_resumed(self, shard_id: int):
+        self.record_shard_event(shard_id, 'resumed')
+
+    async def on_shard_ready(self, shard_id: int):
+        self.record_shard_event(shard_id, 'ready')
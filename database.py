@@ -1,59 +1,227 @@
-from global_vars import DATABASE_DIR
+from global_vars import DATABASE_CACHE_SIZE, COMPACT_SNAPSHOT
+from storage import STORAGE
+from persistence import WRITER
+from metrics import METRICS
+from spectators import SpectatorIndex
+from logger import logger
+from collections import OrderedDict
+import asyncio
 import discord
-import json
+
+# 1: games and linked players keyed by display name, 2: keyed by member id
+SCHEMA_VERSION = 2
 
 class Database:
     def __init__(self, guild: discord.Guild) -> None:
         self.guild = guild
         self.guild_name = guild.name
-        self.path = DATABASE_DIR / f'{self.guild_name}_{self.guild.id}.json'
         self.storyteller_role_id = None
         self.timers = {}
+        self.games = {}
+        self.spectators = SpectatorIndex()
 
-        if self.path.exists():
-            with open(self.path, 'r') as f:
-                self.dict = json.load(f)
-                self.storyteller_role_id = self.dict["storyteller_role_id"]
+        with METRICS.timed('storage_seconds', operation='read'):
+            stored_dict = STORAGE.load(guild.id, self.guild_name)
+        if stored_dict is not None:
+            self.dict = stored_dict
+            self.storyteller_role_id = self.dict["storyteller_role_id"]
+            migrating = self.dict.get('schema_version', 1) < SCHEMA_VERSION and "unmigrated" not in self.dict
+            if migrating:
+                self.start_member_id_migration()
+            self.games = {int(owner_id): game for owner_id, game in self.dict.get('games').items()}
+            self.spectators = SpectatorIndex({
+                int(leader_id): [int(spectator_id) for spectator_id in spectator_ids]
+                for leader_id, spectator_ids in self.dict.get('linked_players').items()
+            })
+            if "unmigrated" in self.dict:
+                cached = {name: member.id for name in self.unmigrated_names() if (member := self.guild.get_member_named(name)) is not None}
+                if self.migrate_members(cached) or migrating:
+                    self.save()
         else:
             self.get_dict_from_guild()
 
-        self.games = self.dict.get('games')
-        self.linked_players = self.dict.get('linked_players')
+    def start_member_id_migration(self) -> None:
+        # Entries keyed by display name wait in "unmigrated" until their member is found. Without
+        # the members intent only members in voice are cached at startup, the others are looked
+        # up by fetch_unmigrated_members and the schema version only moves on once all are found
+        logger.info(f'Migrating Database of {self.guild_name} from display names to member ids')
+        self.dict["unmigrated"] = {"games": self.dict.get('games'), "linked_players": self.dict.get('linked_players')}
+        self.dict["games"] = {}
+        self.dict["linked_players"] = {}
+
+    def unmigrated_names(self) -> set[str]:
+        unmigrated = self.dict.get("unmigrated", {"games": {}, "linked_players": {}})
+        names = set(unmigrated["games"])
+        for leader_name, spectator_names in unmigrated["linked_players"].items():
+            names.add(leader_name)
+            names.update(spectator_names)
+        return names
+
+    def migrate_members(self, member_ids: dict[str, int]) -> bool:
+        unmigrated = self.dict["unmigrated"]
+        migrated = 0
+        for owner_name in [owner_name for owner_name in unmigrated["games"] if owner_name in member_ids]:
+            self.games.setdefault(member_ids[owner_name], {**unmigrated["games"].pop(owner_name), "owner_name": owner_name})
+            migrated += 1
+        for leader_name, spectator_names in list(unmigrated["linked_players"].items()):
+            leader_id = member_ids.get(leader_name)
+            if leader_id is None:
+                continue
+            waiting = []
+            for spectator_name in spectator_names:
+                spectator_id = member_ids.get(spectator_name)
+                if spectator_id is None:
+                    waiting.append(spectator_name)
+                    continue
+                self.spectators.link(spectator_id, leader_id)
+                migrated += 1
+            if waiting:
+                unmigrated["linked_players"][leader_name] = waiting
+            else:
+                del unmigrated["linked_players"][leader_name]
+        if not unmigrated["games"] and not unmigrated["linked_players"]:
+            del self.dict["unmigrated"]
+            self.dict["schema_version"] = SCHEMA_VERSION
+            logger.info(f'Migrated Database of {self.guild_name} to member ids')
+            return True
+        if migrated:
+            logger.info(f'Migrated {migrated} entries of {self.guild_name} to member ids')
+        logger.warning(f'Members {", ".join(sorted(self.unmigrated_names()))} of {self.guild_name} not found yet, their games and spectator links are kept until they are')
+        return migrated > 0
+
+    async def fetch_unmigrated_members(self) -> None:
+        member_ids = {}
+        for name in self.unmigrated_names():
+            try:
+                members = await self.guild.query_members(query=name, limit=100)
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                logger.warning(f'Could not look up {name} in {self.guild_name}:\n{e}')
+                continue
+            member = discord.utils.find(lambda member: name in (member.display_name, member.name, member.global_name), members)
+            if member is not None:
+                member_ids[name] = member.id
+        if self.migrate_members(member_ids):
+            self.save()
+
+    def member_name(self, member_id: int) -> str:
+        member = self.guild.get_member(member_id)
+        return member.display_name if member else str(member_id)
+
+    def is_idle(self) -> bool:
+        return not self.games and not self.spectators
 
-    def save(self):
-        if self.path.exists():
-            self.dict["games"] = self.games
-            self.dict["linked_players"] = self.linked_players
-            self.dict["storyteller_role_id"] = self.storyteller_role_id 
-        with open(self.path, 'w') as f:
-            json.dump(self.dict, f, indent=2)
+    def save(self, table: str | None = None, key: str | int | None = None):
+        # Without a table the whole guild is written, otherwise only the row for key in
+        # "games", "linked_players" (keyed by spectator) or, for any other table name, the guild metadata
+        self.dict["games"] = self.games
+        self.dict["linked_players"] = self.spectators.to_dict()
+        self.dict["storyteller_role_id"] = self.storyteller_role_id
+        STORAGE.write(self, table, key)
 
     def get_dict_from_guild(self) -> None:
         self.dict = {
             "guild": {
                 "name": self.guild_name,
                 "id": self.guild.id,
-                "categories": {
-                    category.name: {
-                        "id": category.id, 
-                        "children": {
-                            channel.name: {
-                                "type": channel.type.name, 
-                                "id": channel.id
-                                } for channel in category.channels
-                                }} for category in self.guild.categories},
-                "roles": {
-                    role.name: {
-                        "id": role.id,
-                        "assignable": role.is_assignable(),
-                        "bot_managed": role.is_bot_managed(),
-                        "is_default": role.is_default(),
-                        "permissions": {key: value for key, value in role.permissions.__iter__()}
-                    } for role in self.guild.roles
-                }
+                "categories": {category.name: self.category_entry(category) for category in self.guild.categories},
+                "roles": {role.name: self.role_entry(role) for role in self.guild.roles}
             },
             "games": {},
             "linked_players": {},
-            "storyteller_role_id": None
+            "storyteller_role_id": None,
+            "schema_version": SCHEMA_VERSION
         }
         self.save()
+
+    @staticmethod
+    def channel_entry(channel: discord.abc.GuildChannel) -> dict:
+        return {"type": channel.type.name, "id": channel.id}
+
+    def category_entry(self, category: discord.CategoryChannel) -> dict:
+        return {"id": category.id, "children": {channel.name: self.channel_entry(channel) for channel in category.channels}}
+
+    @staticmethod
+    def role_entry(role: discord.Role) -> dict:
+        if COMPACT_SNAPSHOT:
+            return {"id": role.id}
+        return {
+            "id": role.id,
+            "assignable": role.is_assignable(),
+            "bot_managed": role.is_bot_managed(),
+            "is_default": role.is_default(),
+            "permissions": {key: value for key, value in role.permissions.__iter__()}
+        }
+
+    def pop_channel_entry(self, channel_id: int) -> None:
+        categories = self.dict["guild"]["categories"]
+        for category_name, category in categories.items():
+            if category["id"] == channel_id:
+                del categories[category_name]
+                return
+            for channel_name, channel in category["children"].items():
+                if channel["id"] == channel_id:
+                    del category["children"][channel_name]
+                    return
+
+    def patch_channel(self, channel: discord.abc.GuildChannel) -> None:
+        self.pop_channel_entry(channel.id)
+        categories = self.dict["guild"]["categories"]
+        if isinstance(channel, discord.CategoryChannel):
+            categories[channel.name] = self.category_entry(channel)
+        elif channel.category is not None:
+            category = categories.setdefault(channel.category.name, {"id": channel.category.id, "children": {}})
+            category["children"][channel.name] = self.channel_entry(channel)
+        self.save('meta', 'guild')
+
+    def remove_channel(self, channel: discord.abc.GuildChannel) -> None:
+        self.pop_channel_entry(channel.id)
+        self.save('meta', 'guild')
+
+    def pop_role_entry(self, role_id: int) -> None:
+        roles = self.dict["guild"]["roles"]
+        for role_name, role in roles.items():
+            if role["id"] == role_id:
+                del roles[role_name]
+                return
+
+    def patch_role(self, role: discord.Role) -> None:
+        self.pop_role_entry(role.id)
+        self.dict["guild"]["roles"][role.name] = self.role_entry(role)
+        self.save('meta', 'guild')
+
+    def remove_role(self, role: discord.Role) -> None:
+        self.pop_role_entry(role.id)
+        self.save('meta', 'guild')
+
+
+DATABASES: OrderedDict[int, Database] = OrderedDict()
+
+def get_database(guild: discord.Guild) -> Database:
+    database = DATABASES.get(guild.id)
+    if database is None:
+        database = Database(guild)
+        DATABASES[guild.id] = database
+        evict_idle_databases()
+        return database
+    DATABASES.move_to_end(guild.id)
+    database.guild = guild
+    return database
+
+def peek_database(guild_id: int) -> Database | None:
+    # Never loads from storage. Guilds with games or spectators are never evicted and every
+    # guild is loaded on startup, so a guild that is not here has no spectators.
+    return DATABASES.get(guild_id)
+
+def invalidate_database(guild_id: int) -> None:
+    DATABASES.pop(guild_id, None)
+
+def evict_idle_databases() -> None:
+    overflow = len(DATABASES) - DATABASE_CACHE_SIZE
+    # The most recently used guild is skipped, it was just loaded for a caller that is about to use it
+    for guild_id in list(DATABASES)[:-1]:
+        if overflow <= 0:
+            return
+        # A guild whose last changes are not written yet would be loaded again without them
+        if DATABASES[guild_id].is_idle() and not WRITER.has_unwritten(guild_id):
+            del DATABASES[guild_id]
+            overflow -= 1
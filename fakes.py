@@ -0,0 +1,337 @@
+from scheduler import Scheduler
+from collections import Counter
+from typing import Callable
+import asyncio
+import discord
+import itertools
+import random
+
+# Stand-ins for the parts of discord.py the bot touches, so its real code can run without
+# a Discord connection. Every REST call sleeps for the simulated latency of FakeDiscord and
+# is counted per operation.
+
+snowflakes = itertools.count(1_000_000_000_000_000)
+
+
+class FakeDiscord:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.calls: Counter[str] = Counter()
+
+    async def rest(self, operation: str) -> None:
+        self.calls[operation] += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+
+class FakeRole:
+    def __init__(self, guild: 'FakeGuild', name: str, default: bool = False) -> None:
+        self.id = guild.id if default else next(snowflakes)
+        self.guild = guild
+        self.name = name
+        self.permissions = discord.Permissions.none()
+        self.default = default
+
+    def is_assignable(self) -> bool:
+        return not self.default
+
+    def is_bot_managed(self) -> bool:
+        return self.name == 'BotC-bot'
+
+    def is_default(self) -> bool:
+        return self.default
+
+
+class FakeVoiceState:
+    def __init__(self, channel: 'FakeVoiceChannel | None') -> None:
+        self.channel = channel
+
+
+class FakeMember:
+    def __init__(self, guild: 'FakeGuild', name: str, bot: bool = False) -> None:
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.roles: list[FakeRole] = [guild.default_role]
+        self.voice: FakeVoiceState | None = None
+
+    def get_role(self, role_id: int) -> FakeRole | None:
+        return discord.utils.get(self.roles, id=role_id)
+
+    def join(self, channel: 'FakeVoiceChannel | None') -> FakeVoiceState:
+        # Moves the member without a REST call and returns the voice state it left
+        before = self.voice or FakeVoiceState(None)
+        if before.channel is not None:
+            before.channel.members.remove(self)
+        if channel is not None:
+            channel.members.append(self)
+        self.voice = FakeVoiceState(channel)
+        return before
+
+    async def move_to(self, channel: 'FakeVoiceChannel') -> None:
+        await self.guild.discord.rest('move_to')
+        before = self.join(channel)
+        if self.guild.on_voice_state_update:
+            await self.guild.on_voice_state_update(self, before, self.voice)
+
+    async def add_roles(self, *roles: FakeRole) -> None:
+        await self.guild.discord.rest('add_roles')
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles: FakeRole) -> None:
+        await self.guild.discord.rest('remove_roles')
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeTextChannel', content: str, author: FakeMember | None = None) -> None:
+        self.id = next(snowflakes)
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.created_at = discord.utils.utcnow()
+
+    async def edit(self, content: str | None = None, **kwargs) -> None:
+        await self.channel.guild.discord.rest('edit_message')
+        self.content = content
+
+    async def delete(self) -> None:
+        await self.channel.guild.discord.rest('delete_message')
+        self.channel.messages.remove(self)
+
+
+class FakeChannel:
+    type = discord.ChannelType.text
+
+    def __init__(self, guild: 'FakeGuild', name: str, category: 'FakeCategory | None' = None, overwrites: dict | None = None) -> None:
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.name = name
+        self.category = category
+        self.overwrites = overwrites or {}
+        guild.channels[self.id] = self
+
+    async def edit(self, **kwargs) -> None:
+        await self.guild.discord.rest('edit_channel')
+        self.name = kwargs.get('name', self.name)
+        self.overwrites = kwargs.get('overwrites', self.overwrites)
+
+    async def delete(self) -> None:
+        await self.guild.discord.rest('delete_channel')
+        self.guild.channels.pop(self.id, None)
+        if self.category is not None:
+            self.category.children.remove(self)
+
+
+class FakeVoiceChannel(FakeChannel):
+    type = discord.ChannelType.voice
+
+    def __init__(self, guild: 'FakeGuild', name: str, category: 'FakeCategory | None' = None, overwrites: dict | None = None) -> None:
+        super().__init__(guild, name, category, overwrites)
+        self.members: list[FakeMember] = []
+
+
+class FakeTextChannel(FakeChannel):
+    def __init__(self, guild: 'FakeGuild', name: str, category: 'FakeCategory | None' = None, overwrites: dict | None = None) -> None:
+        super().__init__(guild, name, category, overwrites)
+        self.messages: list[FakeMessage] = []
+
+    async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+        await self.guild.discord.rest('send_message')
+        message = FakeMessage(self, content, self.guild.me)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit: int | None = None, after=None):
+        for message in reversed(self.messages[-limit if limit else None:]):
+            if after is None or message.created_at > after:
+                yield message
+
+    async def delete_messages(self, messages: list[FakeMessage]) -> None:
+        await self.guild.discord.rest('delete_messages')
+        deleted = set(message.id for message in messages)
+        self.messages = [message for message in self.messages if message.id not in deleted]
+
+
+class FakeCategory(FakeChannel):
+    type = discord.ChannelType.category
+
+    def __init__(self, guild: 'FakeGuild', name: str, overwrites: dict | None = None) -> None:
+        super().__init__(guild, name, None, overwrites)
+        self.children: list[FakeChannel] = []
+
+    @property
+    def channels(self) -> list[FakeChannel]:
+        return list(self.children)
+
+    @property
+    def voice_channels(self) -> list[FakeVoiceChannel]:
+        return [channel for channel in self.children if isinstance(channel, FakeVoiceChannel)]
+
+    @property
+    def text_channels(self) -> list[FakeTextChannel]:
+        return [channel for channel in self.children if isinstance(channel, FakeTextChannel)]
+
+    def add_voice_channel(self, name: str, position: int | None = None) -> FakeVoiceChannel:
+        channel = FakeVoiceChannel(self.guild, name, self, self.overwrites)
+        self.children.insert(len(self.children) if position is None else position, channel)
+        return channel
+
+    def add_text_channel(self, name: str) -> FakeTextChannel:
+        channel = FakeTextChannel(self.guild, name, self, self.overwrites)
+        self.children.append(channel)
+        return channel
+
+    async def create_voice_channel(self, name: str, overwrites: dict | None = None, position: int | None = None) -> FakeVoiceChannel:
+        await self.guild.discord.rest('create_voice_channel')
+        return self.add_voice_channel(name, position)
+
+    async def create_text_channel(self, name: str, overwrites: dict | None = None) -> FakeTextChannel:
+        await self.guild.discord.rest('create_text_channel')
+        return self.add_text_channel(name)
+
+
+class FakeGuild:
+    def __init__(self, fake_discord: FakeDiscord, name: str) -> None:
+        self.id = next(snowflakes)
+        self.discord = fake_discord
+        self.name = name
+        self.channels: dict[int, FakeChannel] = {}
+        self.members: dict[int, FakeMember] = {}
+        self.default_role = FakeRole(self, '@everyone', default=True)
+        self.roles = [self.default_role] + [FakeRole(self, name) for name in ('Storyteller', 'BotC-bot', 'Admin')]
+        self.me = self.add_member('BotC-bot', bot=True)
+        # Called with (member, before, after) after every move, like the gateway event would be
+        self.on_voice_state_update: Callable | None = None
+
+    @property
+    def categories(self) -> list[FakeCategory]:
+        return [channel for channel in self.channels.values() if isinstance(channel, FakeCategory)]
+
+    def add_member(self, name: str, bot: bool = False) -> FakeMember:
+        member = FakeMember(self, name, bot)
+        self.members[member.id] = member
+        return member
+
+    def add_category(self, name: str) -> FakeCategory:
+        return FakeCategory(self, name)
+
+    def get_member(self, member_id: int) -> FakeMember | None:
+        return self.members.get(member_id)
+
+    def get_member_named(self, name: str) -> FakeMember | None:
+        return discord.utils.get(self.members.values(), display_name=name)
+
+    def get_channel(self, channel_id: int) -> FakeChannel | None:
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id: int) -> FakeRole | None:
+        return discord.utils.get(self.roles, id=role_id)
+
+    async def create_category(self, name: str, overwrites: dict | None = None) -> FakeCategory:
+        await self.discord.rest('create_category')
+        return FakeCategory(self, name, overwrites)
+
+    async def create_role(self, name: str) -> FakeRole:
+        await self.discord.rest('create_role')
+        role = FakeRole(self, name)
+        self.roles.append(role)
+        return role
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.scheduler = Scheduler()
+        self.timers = {}
+
+
+class FakeResponse:
+    def __init__(self, interaction: 'FakeInteraction') -> None:
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def reply(self, operation: str) -> None:
+        if self.done:
+            raise discord.InteractionResponded(self.interaction)
+        self.done = True
+        await self.interaction.guild.discord.rest(operation)
+
+    async def send_message(self, content: str | None = None, **kwargs) -> None:
+        await self.reply('interaction_response')
+
+    async def edit_message(self, **kwargs) -> None:
+        await self.reply('interaction_response')
+
+    async def defer(self, **kwargs) -> None:
+        await self.reply('interaction_response')
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction') -> None:
+        self.interaction = interaction
+
+    async def send(self, content: str | None = None, **kwargs) -> None:
+        await self.interaction.guild.discord.rest('followup')
+
+    async def edit_message(self, message_id: int, **kwargs) -> None:
+        await self.interaction.guild.discord.rest('followup')
+
+
+class FakeInteraction:
+    def __init__(self, client, guild: FakeGuild, user: FakeMember, message: FakeMessage | None = None) -> None:
+        self.id = next(snowflakes)
+        self.client = client
+        self.guild = guild
+        self.user = user
+        self.message = message
+        self.extras = {}
+        self.command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs) -> None:
+        await self.guild.discord.rest('edit_original_response')
+
+
+class FakeGame:
+    # A guild with a storyteller, their day and night categories and one member per player
+    def __init__(self, fake_discord: FakeDiscord, name: str, players: int) -> None:
+        self.guild = FakeGuild(fake_discord, name)
+        self.storyteller = self.guild.add_member(f'{name} Storyteller')
+        self.storyteller.roles.append(discord.utils.get(self.guild.roles, name='Storyteller'))
+        self.day_category = self.guild.add_category(f"{self.storyteller.display_name}'s Game")
+        self.night_category = self.guild.add_category(f"{self.storyteller.display_name}'s Night")
+        self.day_channels = [self.day_category.add_voice_channel(f'Room {number}') for number in range(10)]
+        self.town_square = self.day_category.add_voice_channel('Town Square')
+        self.game_chat = self.day_category.add_text_channel('game-chat')
+        self.night_channels = [self.night_category.add_voice_channel(f'Cottage {number}') for number in range(players)]
+        self.players = [self.guild.add_member(f'{name} Player {number}') for number in range(players)]
+        self.storyteller.join(self.town_square)
+
+    def game_dict(self, message_id: int) -> dict:
+        return {
+            "owner_name": self.storyteller.display_name,
+            "message_id": message_id,
+            "day_category": [self.day_category.id, self.day_category.name],
+            "night_category": [self.night_category.id, self.night_category.name],
+            "game_chat_channel": [self.game_chat.id, self.game_chat.name],
+            "town_square_channel": [self.town_square.id, self.town_square.name],
+            "started_at": discord.utils.utcnow().isoformat()
+        }
+
+    def seat_at_night(self) -> None:
+        for player, channel in zip(self.players, self.night_channels):
+            player.join(channel)
+
+    def seat_in_town_square(self) -> None:
+        for player in self.players:
+            player.join(self.town_square)
+
+    def scatter_over_day_channels(self) -> None:
+        for player in self.players:
+            player.join(random.choice(self.day_channels))
@@ -0,0 +1,76 @@
+from logger import logger
+from global_vars import REST_RETRIES, REST_BACKOFF
+from metrics import METRICS
+from typing import Awaitable, Callable
+import asyncio
+import discord
+import time
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+
+class FanOutReport:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.done = 0
+        self.failures: dict[str, Exception] = {}
+        self.results: dict[str, object] = {}
+        self.elapsed = 0.0
+
+    @property
+    def succeeded(self) -> int:
+        return self.done - len(self.failures)
+
+    def summary(self, verb: str) -> str:
+        summary = f'{verb} {self.succeeded}/{self.total} in {self.elapsed:.2f}s'
+        if self.failures:
+            summary += f', failed: {", ".join(self.failures)}'
+        return summary
+
+
+def retry_delay(error: Exception, attempt: int) -> float | None:
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.HTTPException) and (error.status == 429 or error.status >= 500):
+        return REST_BACKOFF * 2 ** attempt
+    return None
+
+
+async def with_backoff(action: Callable[[], Awaitable], retries: int = REST_RETRIES, on_retry: Callable[[float], None] | None = None):
+    attempt = 0
+    while True:
+        try:
+            return await action()
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt >= retries:
+                raise
+            attempt += 1
+            if isinstance(e, discord.RateLimited) or getattr(e, 'status', None) == 429:
+                METRICS.inc('rate_limited_total')
+            METRICS.inc('retries_total')
+            if on_retry:
+                on_retry(delay)
+            logger.warning(f'Discord asked to slow down, retrying in {delay:.2f}s (attempt {attempt}/{retries})')
+            await asyncio.sleep(delay)
+
+
+async def fan_out(actions: dict[str, Callable[[], Awaitable]], limit: int, on_progress: ProgressCallback | None = None, retries: int = REST_RETRIES) -> FanOutReport:
+    report = FanOutReport(len(actions))
+    semaphore = asyncio.Semaphore(limit)
+    started = time.perf_counter()
+
+    async def run(name: str, action: Callable[[], Awaitable]):
+        async with semaphore:
+            try:
+                report.results[name] = await with_backoff(action, retries)
+            except Exception as e:
+                logger.error(f'{name} failed with error:\n{e}')
+                report.failures[name] = e
+        report.done += 1
+        if on_progress:
+            await on_progress(report.done, report.total)
+
+    await asyncio.gather(*(run(name, action) for name, action in actions.items()))
+    report.elapsed = time.perf_counter() - started
+    return report
@@ -1,8 +1,54 @@
 from pathlib import Path
+import os
 
 SCRIPT_DIR = Path(__file__).parent
 DATABASE_DIR = SCRIPT_DIR / 'databases'
 DATABASE_DIR.mkdir(exist_ok=True)
+# Guilds without running games or spectators are dropped from memory past this many
+DATABASE_CACHE_SIZE = 256
+# Seconds that saves are collected for before they are written to disk together
+FLUSH_INTERVAL = 2.0
+# Leaves the role flags and permissions nothing reads out of the stored guild snapshot
+COMPACT_SNAPSHOT = False
+# Either "json" for one file per guild in DATABASE_DIR or "sqlite" for a single WAL database
+STORAGE_BACKEND = 'json'
+SQLITE_PATH = DATABASE_DIR / 'botc.sqlite3'
+# How many moves and role changes of a guild run at the same time. Channel changes run next to
+# those, at most CHANNEL_CONCURRENCY at a time, and countdown messages and control panel edits
+# at most COSMETIC_CONCURRENCY at a time
+ACTION_CONCURRENCY = 5
+COSMETIC_CONCURRENCY = 1
+# How many channels are created or deleted at the same time
+CHANNEL_CONCURRENCY = 5
+# Night channels in every pre-built channel set of the channel pool, enough for any player count
+POOL_NIGHT_CHANNELS = 20
+# Seconds between single deletes of messages that are too old to bulk delete
+OLD_MESSAGE_DELETE_INTERVAL = 1.0
+# Retries and base backoff in seconds for Discord calls that got rate limited or a server error
+REST_RETRIES = 3
+REST_BACKOFF = 0.5
+# How many guilds are set up at the same time when the bot starts
+STARTUP_CONCURRENCY = 8
+# Control panel edits requested within this many seconds are sent to Discord as one edit
+VIEW_EDIT_INTERVAL = 1.0
+# Seconds a temporary button label like "Timer cancelled!" stays before it is reset
+TRANSIENT_LABEL_DURATION = 3
+# The countdown message in game-chat is edited every this many seconds while more than the
+# given seconds are left, coarse early on and finer near the end
+TIMER_UPDATE_INTERVALS = [(180, 60), (60, 30), (0, 10)]
+# Seconds the final "Voting now!" countdown message stays in game-chat
+TIMER_FINAL_MESSAGE_DURATION = 60
+# Local address the Prometheus style metrics are served on at /metrics, an empty BOTC_METRICS_PORT
+# or BOTC_METRICS_PORT=off turns it off
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT_SETTING = os.environ.get('BOTC_METRICS_PORT', '9108').strip()
+METRICS_PORT = None if METRICS_PORT_SETTING.lower() in ('', 'off') else int(METRICS_PORT_SETTING)
+# Set by launcher.py for every shard process, without them the bot runs as a single unsharded client
+SHARD_COUNT = int(os.environ['BOTC_SHARD_COUNT']) if 'BOTC_SHARD_COUNT' in os.environ else None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ['BOTC_SHARD_IDS'].split(',')] if 'BOTC_SHARD_IDS' in os.environ else None
+# Seconds between shard health checks and the heartbeat latency a shard is warned about at
+SHARD_HEALTH_INTERVAL = 60
+SHARD_LATENCY_WARNING = 1.0
 
 DOCUMENTATION_STRING_1 = """
 1/2
@@ -24,7 +70,7 @@ The game controls have the following buttons:
 - Night - Moves all players except you from the town_square channel to the night channels, each player to their own channel.
 - Cancel timer - Cancels the timer if one was set, see more about timers below
 - Quit game - Quits the game and removes the Storyteller role from you
-- Select time players have until vote - Select how many minutes the timer should take. If the timer reaches 0 all players from the day channels are moved to the Town Square channel. This is used to give players a certain time to talk before voting starts. This also updates the #game-chat channel every 30 seconds so players know how much time they have left.
+- Select time players have until vote - Select how many minutes the timer should take. If the timer reaches 0 all players from the day channels are moved to the Town Square channel. This is used to give players a certain time to talk before voting starts. This also keeps a countdown message in the #game-chat channel up to date so players know how much time they have left, every minute at first and every 10 seconds in the last minute.
 
 /stop_game
 Stop the game. You should always try to stop the game with the "Quit game" button. But if for some reason that doesn't work you can stop the game using this command, this does not remove the Storyteller role use /st for that.
@@ -39,7 +85,7 @@ This creates the channels for a game. If you can just use existing channels by l
 This deletes the game channels specified by you. This will only delete channels made by this bot. It will throw an error if you try to delete non bot made categories and it won't delete anything then.
 
 /clean_channel
-This deletes all messages from a text channel. This is meant for clearing the #game-chat channel. This will only clear channels made by the bot, it will throw an error and not delete anything when trying to clear a non bot created channel.
+This deletes all messages from a text channel. This is meant for clearing the #game-chat channel. Set bot_only to only delete messages from bots, or since_game_start to only delete messages sent since your running game started. Messages older than 14 days are deleted slowly in the background. This will only clear channels made by the bot, it will throw an error and not delete anything when trying to clear a non bot created channel.
 
 /st
 This gives you the Storyteller role. This allows you to see the night channels and join them. This is also needed before trying to run /game since if you have no Storyteller role you won't be able to link the night category to your game.
@@ -47,6 +93,15 @@ This gives you the Storyteller role. This allows you to see the night channels a
 /help
 This returns all of this information and deletes it after 3 minutes to not fill your entire screen.
 
+/channel_pool
+Admin only. Keeps between low and high pre-built game channel sets ready so /create_game_channels is instant. Sets are returned to the pool when the game ends and refilled in the background once fewer than low are left. Set high to 0 to turn the pool off.
+
+/resync
+Admin only. Syncs the slash commands to this guild again, or with all_guilds to every guild of this bot process. Only needed when commands are missing or outdated.
+
+/stats
+Admin only. Shows how often every command, button and Discord call ran and how long it took, plus rate limits and retries.
+
 """
 
 DOCUMENTATION_STRINGS = [DOCUMENTATION_STRING_1, DOCUMENTATION_STRING_2]
@@ -262,5 +317,3 @@ ROOMS = [
 	"Wiring closet"
 ]
 ROOMS_COUNT = len(ROOMS)
-
-TIMERS = {}
\ No newline at end of file
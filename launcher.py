@@ -0,0 +1,154 @@
+from logger import logger
+from global_vars import SCRIPT_DIR, METRICS_PORT
+from utils import load_token_from_file
+import argparse
+import asyncio
+import discord
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Runs the bot sharded over several processes, every process runs main.py with an
+# AutoShardedClient for its own group of shards:
+#   python launcher.py --processes 4
+# Every process logs to logs/botc-shards-<first>-<last>.log and serves its metrics on
+# METRICS_PORT + its index, unless metrics are turned off.
+
+TOKEN_PATH = SCRIPT_DIR / 'token.txt'
+MAIN_PATH = SCRIPT_DIR / 'main.py'
+# Discord allows max_concurrency shards to identify every this many seconds
+IDENTIFY_INTERVAL = 5.0
+# A process that crashes is restarted after this many seconds, doubling up to the maximum
+RESTART_BACKOFF = 5.0
+MAX_RESTART_BACKOFF = 300.0
+# A process that ran this long before crashing starts over at RESTART_BACKOFF
+HEALTHY_UPTIME = 600.0
+
+
+async def recommended_shards(token: str) -> tuple[int, int]:
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        shards, _, session_start_limit = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards, session_start_limit["max_concurrency"]
+
+
+def shard_groups(shard_count: int, processes: int) -> list[list[int]]:
+    processes = min(processes, shard_count)
+    size = math.ceil(shard_count / processes)
+    return [list(range(start, min(start + size, shard_count))) for start in range(0, shard_count, size)]
+
+
+class ShardProcess:
+    def __init__(self, index: int, shard_ids: list[int], shard_count: int) -> None:
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.name = f'shards-{shard_ids[0]}-{shard_ids[-1]}'
+        self.process: subprocess.Popen | None = None
+        self.started = 0.0
+        self.backoff = RESTART_BACKOFF
+        self.restart_at: float | None = None
+
+    def environment(self) -> dict[str, str]:
+        environment = {
+            **os.environ,
+            "BOTC_SHARD_COUNT": str(self.shard_count),
+            "BOTC_SHARD_IDS": ','.join(map(str, self.shard_ids)),
+            "BOTC_SHARD_GROUP": self.name,
+        }
+        if METRICS_PORT is not None:
+            environment["BOTC_METRICS_PORT"] = str(METRICS_PORT + self.index)
+        return environment
+
+    def start(self) -> None:
+        logger.info(f'Starting {self.name} with shards {self.shard_ids} of {self.shard_count}')
+        self.process = subprocess.Popen([sys.executable, str(MAIN_PATH)], env=self.environment(), cwd=SCRIPT_DIR, start_new_session=True)
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def check(self) -> None:
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+        returncode = self.process.poll()
+        if returncode is None:
+            return
+        if time.monotonic() - self.started >= HEALTHY_UPTIME:
+            self.backoff = RESTART_BACKOFF
+        logger.error(f'{self.name} exited with code {returncode}, restarting in {self.backoff:.0f}s')
+        self.restart_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_RESTART_BACKOFF)
+
+    def stop(self) -> None:
+        if self.process and self.process.poll() is None:
+            # SIGINT lets discord.py close the client, which flushes pending database writes.
+            # The processes run in their own session so a Ctrl+C only reaches the launcher
+            self.process.send_signal(signal.SIGINT)
+
+    def wait(self, timeout: float) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.error(f'{self.name} did not stop within {timeout:.0f}s, killing it')
+            self.process.kill()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs the bot sharded over several processes')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shards', type=int, help='Total shard count, defaults to what Discord recommends')
+    parser.add_argument('--max-concurrency', type=int, help='Shards that may identify at the same time, defaults to what Discord allows')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    shard_count, max_concurrency = args.shards, args.max_concurrency
+    if shard_count is None or max_concurrency is None:
+        recommended_count, allowed_concurrency = asyncio.run(recommended_shards(load_token_from_file(TOKEN_PATH).strip()))
+        shard_count = shard_count or recommended_count
+        max_concurrency = max_concurrency or allowed_concurrency
+    groups = shard_groups(shard_count, args.processes)
+    logger.info(f'Running {shard_count} shards in {len(groups)} processes, {max_concurrency} identifying at a time')
+    processes = [ShardProcess(index, shard_ids, shard_count) for index, shard_ids in enumerate(groups)]
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Every process identifies its shards one after the other, the next process starts once
+    # the shards of the previous one had their turn
+    for shard_process in processes:
+        if stopping:
+            break
+        shard_process.start()
+        time.sleep(math.ceil(len(shard_process.shard_ids) / max_concurrency) * IDENTIFY_INTERVAL)
+
+    while not stopping:
+        for shard_process in processes:
+            shard_process.check()
+        time.sleep(1)
+
+    logger.info('Stopping all shard processes')
+    for shard_process in processes:
+        shard_process.stop()
+    for shard_process in processes:
+        shard_process.wait(30)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,74 @@
+import atexit
+import gzip
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
 from colorlog import ColoredFormatter
-from datetime import datetime
 from pathlib import Path
 
 SCRIPT_DIR = Path(__file__).parent
-TODAY = datetime.today().strftime('%d-%m-%Y')
 LOG_DIR = SCRIPT_DIR / 'logs'
 LOG_DIR.mkdir(exist_ok=True)
-LOG_FILE_PATH = LOG_DIR / f'{TODAY}.log'
+# Every shard process started by launcher.py logs to its own file
+SHARD_GROUP = os.environ.get('BOTC_SHARD_GROUP')
+LOG_FILE_PATH = LOG_DIR / (f'botc-{SHARD_GROUP}.log' if SHARD_GROUP else 'botc.log')
+LOG_PREFIX = f'[{SHARD_GROUP}] ' if SHARD_GROUP else ''
+# Rotated log files are kept this many days, gzipped
+LOG_RETENTION_DAYS = 30
+# Every high-frequency call site may log this many DEBUG/INFO records per window, the rest is
+# counted and dropped. Call sites opt in with extra=SAMPLED, all other records are always kept
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 60.0
+SAMPLED = {'sampled': True}
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit: int, window: float) -> None:
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.call_sites: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, 'sampled', False):
+            return True
+        now = time.monotonic()
+        call_site = self.call_sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+        window_start, count, suppressed = call_site
+        if now - window_start >= self.window:
+            call_site[:] = [now, 1, 0]
+            if suppressed:
+                record.msg = f'{record.msg} (suppressed {suppressed} similar messages in the last {self.window:.0f}s)'
+            return True
+        if count < self.limit:
+            call_site[1] += 1
+            return True
+        call_site[2] += 1
+        return False
+
+
+def gzip_rotator(source: str, destination: str) -> None:
+    with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
 
 logger = logging.getLogger('main')
 logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler(LOG_FILE_PATH)
+# Rotates at midnight so every day gets its own file, however long the bot runs. The default
+# %Y-%m-%d suffix is kept, backupCount only finds and sorts old files by that format
+file_handler = logging.handlers.TimedRotatingFileHandler(LOG_FILE_PATH, when='midnight', backupCount=LOG_RETENTION_DAYS)
+file_handler.namer = lambda name: f'{name}.gz'
+file_handler.rotator = gzip_rotator
 stream_handler = logging.StreamHandler()
 file_handler.setLevel(logging.DEBUG)
 stream_handler.setLevel(logging.INFO)
 file_formatter = logging.Formatter('[%(asctime)s] [%(levelname)-7s]: %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
 stream_formatter = ColoredFormatter(
-    '%(log_color)s[%(asctime)s] [%(levelname)-7s]: %(message)s%(reset)s',
+    f'%(log_color)s{LOG_PREFIX}[%(asctime)s] [%(levelname)-7s]: %(message)s%(reset)s',
     datefmt='%d-%m-%Y %H:%M:%S',
     log_colors={
         'DEBUG':    'white',
@@ -28,5 +79,11 @@ stream_formatter = ColoredFormatter(
     })
 file_handler.setFormatter(file_formatter)
 stream_handler.setFormatter(stream_formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+
+# The event loop only puts records on a queue, a listener thread does the formatting and disk I/O
+log_queue = queue.SimpleQueue()
+queue_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+queue_listener.start()
+atexit.register(queue_listener.stop)
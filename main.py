@@ -1,173 +1,267 @@
 import discord
-from logger import logger
+import asyncio
+import time
+from datetime import datetime
+from logger import logger, SAMPLED
 from utils import (
     load_token_from_file, 
     dict_to_str, 
-    pick_random_channel_names, 
-    get_storyteller_role, 
-    check_if_user_has_story_teller_role,
     response,
+    command_fingerprint,
+    is_bot_created,
+    throttled_progress,
     )
-from global_vars import SCRIPT_DIR, DOCUMENTATION_STRINGS
-from classes import MyClient, GameControls
-from database import Database
+from global_vars import SCRIPT_DIR, DOCUMENTATION_STRINGS, STARTUP_CONCURRENCY, SHARD_COUNT, SHARD_IDS
+from classes import MyClient, MyShardedClient, GameControls
+from database import Database, get_database, peek_database, invalidate_database
+from roles import role_index, invalidate_role_index, has_role
+from fanout import with_backoff
+from actions import Priority, enqueue, move_members, rest_call
+from channels import ChannelPlan, ProvisioningError, provision_game_channels, delete_channels, resume_pending_deletions
+from pool import ChannelPool, release_game_channels
+from purge import purge_channel
+from metrics import METRICS, instrumented
 from discord import app_commands
 
 TOKEN_PATH = SCRIPT_DIR / 'token.txt'
-TOKEN = load_token_from_file(TOKEN_PATH)
 
 intents = discord.Intents.default()
-client = MyClient(intents=intents)
-
+if SHARD_COUNT:
+    client = MyShardedClient(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    client = MyClient(intents=intents)
+
+
+async def sync_commands(guild: discord.Guild, force: bool = False) -> bool:
+    database = get_database(guild)
+    fingerprint = command_fingerprint(client.tree)
+    client.tree.copy_global_to(guild=guild)
+    if not force and database.dict.get("command_fingerprint") == fingerprint:
+        logger.info(f'Commands of {guild.name}[{guild.id}] are up to date, not syncing')
+        return True
+    logger.info(f"Syncing commands to {guild.name}[{guild.id}]")
+    try:
+        await with_backoff(lambda: client.tree.sync(guild=guild))
+    except discord.HTTPException as e:
+        logger.error(f'Could not sync commands to {guild.name}[{guild.id}], got error:\n{e}')
+        return False
+    database.dict["command_fingerprint"] = fingerprint
+    database.save('meta', 'command_fingerprint')
+    return True
+
+def restore_game_controls(guild: discord.Guild, database: Database):
+    for owner_id, game in database.games.items():
+        message_id = game.get("message_id")
+        if message_id is None:
+            # Games started before control panels were persistent
+            logger.warning(f'Control panel of {database.member_name(owner_id)} in {guild.name} can not be restored, /stop_game ends the game')
+            continue
+        client.add_view(GameControls(guild.id, owner_id), message_id=message_id)
+
+async def setup_guild(guild: discord.Guild, semaphore: asyncio.Semaphore, force_sync: bool = False):
+    async with semaphore:
+        started = time.perf_counter()
+        logger.info(f'Setting up Database for {guild.name}')
+        database = get_database(guild)
+        if "unmigrated" in database.dict:
+            await database.fetch_unmigrated_members()
+        if database.dict.get("pending_deletions"):
+            client.scheduler.call_later(0, lambda: resume_pending_deletions(database))
+        restore_game_controls(guild, database)
+        if not await sync_commands(guild, force=force_sync):
+            return
+        client.ready_guilds.add(guild.id)
+        logger.info(f'{guild.name}[{guild.id}] ready in {time.perf_counter() - started:.2f}s')
 
 @client.event
 async def on_ready():
-    logger.info(f'Logged in as {client.user} (ID: {client.user.id}), connected to {len(client.guilds)} guilds')
+    shards = f', shards {SHARD_IDS} of {SHARD_COUNT}' if SHARD_COUNT else ''
+    logger.info(f'Logged in as {client.user} (ID: {client.user.id}), connected to {len(client.guilds)} guilds{shards}')
     logger.info('------')
-    for guild in client.guilds:
-        logger.info(f'Setting up Database for {guild.name}')
-        database = Database(guild)
-        database.get_dict_from_guild()
-        guild_name = guild.name
-        logger.info(f"Copying commands to {guild_name}[{guild.id}]")
-        client.tree.copy_global_to(guild=guild)
-        await client.tree.sync(guild=guild)
+    # on_ready also fires after reconnects, guilds that were set up before keep their state
+    pending_guilds = [guild for guild in client.guilds if guild.id not in client.ready_guilds]
+    semaphore = asyncio.Semaphore(STARTUP_CONCURRENCY)
+    started = time.perf_counter()
+    await asyncio.gather(*(setup_guild(guild, semaphore) for guild in pending_guilds))
+    logger.info(f'Set up {len(pending_guilds)} guilds in {time.perf_counter() - started:.2f}s, {len(client.ready_guilds)}/{len(client.guilds)} guilds ready')
+
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    logger.info(f'Joined {guild.name}[{guild.id}]')
+    # Discord drops the commands of a guild that removed the bot, the stored fingerprint of
+    # an earlier stay no longer says anything about them
+    await setup_guild(guild, asyncio.Semaphore(1), force_sync=True)
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    logger.info(f'Removed from {guild.name}[{guild.id}], dropping its Database from memory')
+    invalidate_database(guild.id)
+    invalidate_role_index(guild.id)
+    client.ready_guilds.discard(guild.id)
+
+@client.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+    get_database(channel.guild).patch_channel(channel)
+
+@client.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    get_database(after.guild).patch_channel(after)
+
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    get_database(channel.guild).remove_channel(channel)
 
 @client.event
+async def on_guild_role_create(role: discord.Role):
+    invalidate_role_index(role.guild.id)
+    get_database(role.guild).patch_role(role)
+
+@client.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    invalidate_role_index(after.guild.id)
+    get_database(after.guild).patch_role(after)
+
+@client.event
+async def on_guild_role_delete(role: discord.Role):
+    invalidate_role_index(role.guild.id)
+    get_database(role.guild).remove_role(role)
+
+@client.event
+@instrumented('on_voice_state_update')
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
-    database = Database(member.guild)
-    if not after.channel:
+    # Mute, deafen and stream toggles keep the same channel, only real moves of leaders matter
+    if after.channel is None or before.channel == after.channel:
+        client.voice_event_counts['filtered'] += 1
+        return
+    database = peek_database(member.guild.id)
+    if database is None or not database.spectators.has_spectators(member.id):
+        client.voice_event_counts['filtered'] += 1
         return
-    if member.display_name in database.linked_players:
-        spectators = database.linked_players[member.display_name]
-        for spectator_name in spectators:
-            if before.channel:
-                for channel_member in before.channel.members:
-                    if channel_member.display_name == spectator_name:
-                        logger.info(f"{spectator_name} was in same channel as {member.display_name} moving {spectator_name} to {after.channel.name}")
-                        try:
-                            await member.move_to(after.channel)
-                        except Exception as e:
-                            logger.error(f'While trying to move {member.display_name} to {after.channel.name} got error:\n{e}')
-                        return
-            logger.info(f"{spectator_name} was not in same channel as {member.display_name} moving {spectator_name} to {after.channel.name}")
-            spectator = member.guild.get_member_named(spectator_name)
-            try:
-                await spectator.move_to(after.channel)
-            except Exception as e:
-                logger.error(f'While trying to move {spectator_name} to {after.channel.name} got error:\n{e}')
+    client.voice_event_counts['handled'] += 1
+    moves = []
+    for spectator_id in database.spectators.spectators_of(member.id):
+        spectator = member.guild.get_member(spectator_id)
+        if not spectator or not spectator.voice or spectator.voice.channel == after.channel:
+            continue
+        logger.info(f"Moving {spectator.display_name} to {after.channel.name} following {member.display_name}", extra=SAMPLED)
+        moves.append((spectator, after.channel))
+    await move_members(moves)
 
 @client.tree.command()
 async def spectate(interaction: discord.Interaction, user_to_spectate: discord.Member):
     """Link yourself to another member, when they move channels you move with them"""
-    database = Database(interaction.guild)
+    database = get_database(interaction.guild)
+    spectators = database.spectators
     user = interaction.user
     user_to_spectate_name = user_to_spectate.display_name
     logger.info(f"{user.display_name} called /spectate {user_to_spectate_name}")
-    if user.display_name == user_to_spectate_name:
+    if user.id == user_to_spectate.id:
         logger.error(f"{user.display_name} tried to spectate him or herself!")
         await response(interaction, f'You cannot spectate yourself!')
         return
 
-    if user.display_name in database.linked_players and user_to_spectate_name in database.linked_players[user.display_name]:
+    if spectators.would_create_cycle(user.id, user_to_spectate.id):
         logger.error(f'Infinite spectate loop detected, {user_to_spectate_name} is spectating {user.display_name} so {user.display_name} cannot spectate {user_to_spectate_name} aswell')
         await response(interaction, f'{user_to_spectate_name} is spectating you, you cannot spectate eachother at the same time, ask {user_to_spectate_name} to call /stop_spectate')
         return
 
-    for spectated, spectators in database.linked_players.items():
-        for spectator in spectators:
-            if spectator == user.display_name:
-                logger.warning(f"{user.display_name} is already spectating {spectated}")
-                await response(interaction, f'You are already spectating {spectated}! First unlink from {spectated}!')
-                return
-            
-    if user_to_spectate_name in database.linked_players:
-        database.linked_players[user_to_spectate_name].append(user.display_name)
-        database.save()
-        await response(interaction, f'You are now spectating {user_to_spectate_name}, you will follow them around until you run /stop_spectate')
+    spectated_id = spectators.leader_of(user.id)
+    if spectated_id:
+        spectated = database.member_name(spectated_id)
+        logger.warning(f"{user.display_name} is already spectating {spectated}")
+        await response(interaction, f'You are already spectating {spectated}! First unlink from {spectated}!')
         return
 
-    database.linked_players[user_to_spectate_name] = [user.display_name]
-    database.save()
+    spectators.link(user.id, user_to_spectate.id)
+    database.save('linked_players', user.id)
     logger.info(f'{user.display_name} is now spectating {user_to_spectate_name}')
     await response(interaction, f'You are now spectating {user_to_spectate_name}, you will follow them around until you run /stop_spectate')
 
 @client.tree.command()
 async def stop_spectate(interaction: discord.Interaction):
     """Unlink yourself from other members, you no longer move where they move"""
-    database = Database(interaction.guild)
+    database = get_database(interaction.guild)
     user_display_name = interaction.user.display_name
     logger.info(f'{user_display_name} called /stop_spectate')
-    found = False
-    for spectated, spectators in database.linked_players.items():
-        for spectator in spectators:
-            if spectator == user_display_name:
-                spectators.pop(spectators.index(user_display_name))
-                found = True
-                database.save()
-                await response(interaction, f'You are no longer spectating {spectated}')
-                logger.info(f'Unlinked {user_display_name} from {spectated}')
-    if not found:
+    spectated_id = database.spectators.unlink(interaction.user.id)
+    if not spectated_id:
         await response(interaction, f'You are not spectating anyone!')
         logger.warning(f'{user_display_name} was not spectating anyone')
+        return
+    database.save('linked_players', interaction.user.id)
+    spectated = database.member_name(spectated_id)
+    await response(interaction, f'You are no longer spectating {spectated}')
+    logger.info(f'Unlinked {user_display_name} from {spectated}')
 
 @client.tree.command()
 async def game(interaction: discord.Interaction, day_category: discord.CategoryChannel, night_category: discord.CategoryChannel, town_square_channel: discord.VoiceChannel):
     """Gives storyteller buttons to manage the game with"""
     guild = interaction.guild
-    database = Database(guild)
+    database = get_database(guild)
     user = interaction.user
     game_owner = user.display_name
     logger.info(f'{game_owner} called /game "{day_category.name}" "{night_category.name}" "{town_square_channel.name}"')
-    if game_owner in database.games:
+    if user.id in database.games:
         await response(interaction, f'You already have a running game, first quit the other game')
         logger.warning(f'{game_owner} already has a running game')
         return
     
-    view = GameControls(timeout=None)
+    view = GameControls(guild.id, user.id)
     game_chat_channel = discord.utils.get(day_category.text_channels, name='game-chat')
-    database.games[game_owner] = {
-        "view_id": view.id, 
+    database.games[user.id] = {
+        "owner_name": game_owner,
         "day_category": [day_category.id, day_category.name], 
         "night_category": [night_category.id, night_category.name], 
         "game_chat_channel": [game_chat_channel.id, game_chat_channel.name],
-        "town_square_channel": [town_square_channel.id, town_square_channel.name]
+        "town_square_channel": [town_square_channel.id, town_square_channel.name],
+        "started_at": discord.utils.utcnow().isoformat()
         }
-    storyteller_role = get_storyteller_role(guild)
+    storyteller_role = role_index(guild).storyteller(database.storyteller_role_id)
 
     if not storyteller_role:
         logger.warning(f"No Storryteller role found! Adding now...")
         storyteller_role = await guild.create_role(name='Storyteller')
     
     database.storyteller_role_id = storyteller_role.id
-    user_has_story_teller_role = check_if_user_has_story_teller_role(interaction)
+    user_has_story_teller_role = has_role(user, storyteller_role)
+
+    await interaction.response.send_message(f"Game commands for {game_owner}'s game", view=view)
+    # The panel is hooked up to this message again after a restart
+    message = await interaction.original_response()
+    database.games[user.id]["message_id"] = message.id
 
     if not user_has_story_teller_role:
         try:
             logger.info(f'Attempting to add storyteller role to {game_owner}')
-            await user.add_roles(storyteller_role)
+            add_role = rest_call('add_roles', lambda: user.add_roles(storyteller_role))
+            await enqueue(guild, Priority.ROLE, add_role, ('roles', user.id, storyteller_role.id))
             logger.info(f'Successfully added storyteller role to {game_owner}')
         except discord.errors.Forbidden:
             logger.error(f'Could not add storyteller role to {game_owner} because of lacking permissions, add role manually')
-            await response(interaction, f'Could not add Storyteller role to {game_owner}, probably because the user has a higher tier role. Please add manually and try again')
-            database.games.pop(game_owner)
+            database.games.pop(user.id)
+            GameControls.forget(guild.id, user.id)
+            view.stop()
+            await interaction.delete_original_response()
+            await interaction.followup.send(f'Could not add Storyteller role to {game_owner}, probably because the user has a higher tier role. Please add manually and try again', ephemeral=True)
             return
-        
-    database.save()
-    await interaction.response.send_message(f"Game commands for {game_owner}'s game", view=view)
+
+    database.save('games', user.id)
+    database.save('meta', 'storyteller_role_id')
 
 @client.tree.command()
 async def stop_game(interaction: discord.Interaction):
     """Stop game if you have any game running, only use this if game controls no longer work"""
-    database = Database(interaction.guild)
+    database = get_database(interaction.guild)
     game_owner = interaction.user
     game_owner_name = game_owner.display_name
     logger.info(f'{game_owner_name} called /stop_game')
 
-    if game_owner_name in database.games:
-        database.games.pop(game_owner_name)
+    if game_owner.id in database.games:
+        game = database.games.pop(game_owner.id)
+        GameControls.forget(interaction.guild.id, game_owner.id)
         await response(interaction, f'Ended your game, you can now start a new game')
-        database.save()
+        database.save('games', game_owner.id)
+        client.scheduler.call_later(0, lambda: release_game_channels(interaction.guild, game))
         return
     
     await response(interaction, f'No game found for {game_owner_name}, you can freely start a new game')
@@ -177,116 +271,84 @@ async def create_game_channels(interaction: discord.Interaction, amount_of_playe
     """Creates channels for a new game"""
     command_caller = interaction.user.display_name
     logger.info(f'{command_caller} called /create_game_channels {amount_of_players}')
-
-    night_category_name = f"{command_caller}'s Night"
-    random_night_channel_names = pick_random_channel_names(amount_of_players)
-    logger.debug(f'Picked the following random night channel names:\n{random_night_channel_names}')
-
-    day_category_name = f"{command_caller}'s Game"
-    random_day_channel_names = pick_random_channel_names(10)
-    logger.debug(f'Picked the following random day channel names:\n{random_day_channel_names}')
-
-    town_square_name = f"Town Square ({command_caller}'s game)"
-    random_day_channel_names.append(town_square_name)
-
-    channels_to_be_created = {
-        day_category_name: random_day_channel_names,
-        night_category_name: random_night_channel_names
-
-    }
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    plan = ChannelPlan(command_caller, amount_of_players)
+    started = time.perf_counter()
+    claimed = await ChannelPool(get_database(interaction.guild)).claim(plan)
+    if claimed:
+        # A pooled set keeps its own channels, only the categories and Town Square take the names of the plan
+        day_category, night_category = claimed
+        town_square = ChannelPool.town_square(day_category)
+        channels = {
+            plan.day_category_name: [plan.day_channel_names[-1] if channel == town_square else channel.name for channel in day_category.channels],
+            plan.night_category_name: [channel.name for channel in night_category.channels],
+        }
+        await interaction.edit_original_response(content=f"""Took a pre-built channel set from the pool in {time.perf_counter() - started:.2f}s:
+{dict_to_str(channels)}""")
+        return
 
     response_message = f"""These channels will be created:
-{dict_to_str(channels_to_be_created)}
+{dict_to_str(plan.to_dict())}
 """
     logger.debug(response_message)
-    await response(interaction, response_message)
-
-    guild = interaction.guild
-
-    overwrites = {discord.utils.get(guild.roles, name='BotC-bot'): discord.PermissionOverwrite(view_channel=True, manage_channels=True)}
-
-    day_category = await guild.create_category(day_category_name, overwrites=overwrites)
-    logger.info(f"Created {day_category_name} on {guild.name} for {command_caller}'s game")
-
-    for channel_name in random_day_channel_names:
-        await day_category.create_voice_channel(channel_name, overwrites=overwrites)
-        logger.info(f"Created {channel_name} in {day_category_name}")
-    await day_category.create_text_channel('game-chat', overwrites=overwrites)
-    logger.info(f'Created "game-chat" in {day_category_name}')
-
-
-    overwrites = {
-    guild.default_role: discord.PermissionOverwrite(view_channel=False),
-    discord.utils.get(guild.roles, name='Storyteller'): discord.PermissionOverwrite(view_channel=True, manage_channels=True),
-    discord.utils.get(guild.roles, name='BotC-bot'): discord.PermissionOverwrite(view_channel=True, manage_channels=True),
-    discord.utils.get(guild.roles, name='Admin'): discord.PermissionOverwrite(view_channel=True, manage_channels=True)
-    }
-
-    night_category = await guild.create_category(night_category_name, overwrites=overwrites)
-    logger.info(f"Created {night_category_name} on {guild.name} for {command_caller}'s game")
-
-    for channel_name in random_night_channel_names:
-        await night_category.create_voice_channel(channel_name, overwrites=overwrites)
-        logger.info(f"Created {channel_name} in {night_category_name}")
+    report_progress = throttled_progress(interaction, lambda done, total: f'{response_message}Created {done}/{total} channels...')
+    await interaction.edit_original_response(content=response_message)
+    try:
+        _, _, elapsed = await provision_game_channels(interaction.guild, plan, report_progress)
+    except ProvisioningError as e:
+        logger.error(f"Creating channels for {command_caller}'s game failed, removed the channels that were created:\n{e}")
+        await interaction.edit_original_response(content=f'{response_message}{e}, removed the channels that were already created. Please try again')
+        return
+    await interaction.edit_original_response(content=f'{response_message}Created {plan.channel_count} channels in {elapsed:.2f}s')
 
 @client.tree.command()
 async def delete_game_channels(interaction: discord.Interaction, day_category: discord.CategoryChannel, night_category: discord.CategoryChannel):
     """Deletes game channels from a closed game"""
-    day_category_overwrites = day_category.overwrites
-    night_category_overwrites = night_category.overwrites
     logger.info(f'{interaction.user.display_name} called /delete_game_channels "{day_category.name}" "{night_category.name}"')
-
-    allowed_to_delete_day = False
-    for role in day_category_overwrites:
-        if role.name == 'BotC-bot':
-            allowed_to_delete_day = True
-            break
-
-    if not allowed_to_delete_day:
-        await response(interaction, f'The category {day_category.name} was not made by this bot, will not delete anything.')
-        logger.warning(f'The category {day_category.name} was not made by this bot, will not delete anything')
-        return
-    
-    allowed_to_delete_night = False
-    for role in night_category_overwrites:
-        if role.name == 'BotC-bot':
-            allowed_to_delete_night = True
-            break
-
-    if not allowed_to_delete_night:
-        await response(interaction, f'The category {night_category.name} was not made by this bot, will not delete anything.')
-        logger.warning(f'The category {night_category.name} was not made by this bot, will not delete anything')
+    not_bot_created = next((category for category in (day_category, night_category) if not is_bot_created(category)), None)
+    if not_bot_created:
+        await response(interaction, f'The category {not_bot_created.name} was not made by this bot, will not delete anything.')
+        logger.warning(f'The category {not_bot_created.name} was not made by this bot, will not delete anything')
         return
-    
-    await response(interaction, f"Deleting all channels in {day_category.name} and {night_category.name}...")
-    logger.info(f"Deleting all channels in {day_category.name} and {night_category.name}...")
-    for category in [day_category, night_category]:
-        for channel in category.channels:
-            logger.info(f'Deleting {channel.name} from {category.name}')
-            await channel.delete()
-        logger.info(f"Deleting {category.name}")
-        await category.delete()
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    message = f"Deleting all channels in {day_category.name} and {night_category.name}..."
+    await interaction.edit_original_response(content=message)
+    logger.info(message)
+    report_progress = throttled_progress(interaction, lambda done, total: f'{message} {done}/{total}')
+    report = await delete_channels(get_database(interaction.guild), [day_category, night_category], on_progress=report_progress)
+    summary = report.summary('Deleted channels')
+    if report.failures:
+        summary += ', the rest will be retried when the bot restarts'
+    await interaction.edit_original_response(content=summary)
 
 @client.tree.command()
-async def clear_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    """Clears all messages from the channel"""
-    channel_overwrites = channel.overwrites
-    allowed_to_clear_channel = False
-    logger.info(f'{interaction.user.display_name} called /clean_channel "{channel.name}"')
-
-    for role in channel_overwrites:
-        if role.name == 'BotC-bot':
-            allowed_to_clear_channel = True
-            break
-
-    if not allowed_to_clear_channel:
+async def clear_channel(interaction: discord.Interaction, channel: discord.TextChannel, bot_only: bool = False, since_game_start: bool = False):
+    """Clears messages from the channel, optionally only bot messages or messages since your game started"""
+    logger.info(f'{interaction.user.display_name} called /clean_channel "{channel.name}" {bot_only} {since_game_start}')
+
+    if not is_bot_created(channel):
         await response(interaction, f'Channel {channel.name} was not created by this bot, will not clear this channel')
         logger.warning(f'Channel {channel.name} was not created by this bot, will not clear this channel')
         return
 
-    await response(interaction, f"Purging {channel.name}...")
+    after = None
+    if since_game_start:
+        game = get_database(interaction.guild).games.get(interaction.user.id)
+        if not game or "started_at" not in game:
+            await response(interaction, 'You have no running game to clear the messages of')
+            return
+        after = datetime.fromisoformat(game["started_at"])
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    message = f"Purging {channel.name}..."
+    await interaction.edit_original_response(content=message)
     logger.info(f'Clearing {channel.name} of messages')
-    await channel.purge()
+    report_progress = throttled_progress(interaction, lambda deleted, seen: f'{message} deleted {deleted} messages so far')
+    check = (lambda message: message.author.bot) if bot_only else None
+    report = await purge_channel(channel, check=check, after=after, on_progress=report_progress)
+    await interaction.edit_original_response(content=report.summary(channel.name))
 
 @client.tree.command()
 async def st(interaction: discord.Interaction):
@@ -294,32 +356,65 @@ async def st(interaction: discord.Interaction):
     user = interaction.user
     logger.info(f'{user.display_name} called /st')
     guild = interaction.guild
-    database = Database(guild)
-    storyteller_role_id = database.storyteller_role_id
-    if storyteller_role_id:
-        storyteller_role = guild.get_role(storyteller_role_id)
-    else:
-        storyteller_role = get_storyteller_role(guild)
-    user_has_story_teller_role = check_if_user_has_story_teller_role(interaction)
+    database = get_database(guild)
+    storyteller_role = role_index(guild).storyteller(database.storyteller_role_id)
+    user_has_story_teller_role = has_role(user, storyteller_role)
     if user_has_story_teller_role:
         await response(interaction, "You already had the Storyteller role, removing role now")
         try:
             logger.info(f'User {user.display_name} already has the Storryteller role, removing it now')
-            await user.remove_roles(storyteller_role)
+            remove_role = rest_call('remove_roles', lambda: user.remove_roles(storyteller_role))
+            await enqueue(guild, Priority.ROLE, remove_role, ('roles', user.id, storyteller_role.id))
             logger.info(f'Successfully removed storyteller role from {user.display_name}')
         except discord.Forbidden:
-            await response(interaction, 'Bot is not allowed to remove Storyteller role from you, ask a moderator')
+            await interaction.edit_original_response(content='Bot is not allowed to remove Storyteller role from you, ask a moderator')
             logger.error(f'Could not remove Storyteller role from {user.display_name} due to lack of authorization')
         return
+    await response(interaction, 'Giving you the Storyteller role now')
     try:
         logger.info(f'Giving Storyteller role to {user.display_name}')
-        await user.add_roles(storyteller_role)
+        add_role = rest_call('add_roles', lambda: user.add_roles(storyteller_role))
+        await enqueue(guild, Priority.ROLE, add_role, ('roles', user.id, storyteller_role.id))
         logger.info(f'Successfully added Storyteller role to {user.display_name}')
-        await response(interaction, 'Successfully gave you Storyteller role')
+        await interaction.edit_original_response(content='Successfully gave you Storyteller role')
     except discord.Forbidden:
-        await response(interaction, 'Bot is not allowed to give you Storyteller role, ask a moderator')
+        await interaction.edit_original_response(content='Bot is not allowed to give you Storyteller role, ask a moderator')
         logger.error(f'Could not add Storyteller role to {user.display_name} due to lack of authorization')
 
+@client.tree.command()
+@app_commands.default_permissions(administrator=True)
+async def channel_pool(interaction: discord.Interaction, low: app_commands.Range[int, 0, 5], high: app_commands.Range[int, 0, 5]):
+    """Keeps between low and high pre-built game channel sets ready, 0 turns the pool off"""
+    logger.info(f'{interaction.user.display_name} called /channel_pool {low} {high}')
+    if low > high:
+        await response(interaction, 'low cannot be higher than high')
+        return
+    pool = ChannelPool(get_database(interaction.guild))
+    pool.configure(low, high)
+    await response(interaction, f'Channel pool will keep {low} to {high} channel sets ready, {len(pool.sets)} ready right now')
+
+@client.tree.command()
+@app_commands.default_permissions(administrator=True)
+async def resync(interaction: discord.Interaction, all_guilds: bool = False):
+    """Forces the slash commands to be synced again, for this guild or all guilds this bot process serves"""
+    logger.info(f'{interaction.user.display_name} called /resync {all_guilds}')
+    guilds = client.guilds if all_guilds else [interaction.guild]
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    synced = 0
+    for guild in guilds:
+        synced += await sync_commands(guild, force=True)
+    await interaction.followup.send(f'Synced commands to {synced}/{len(guilds)} guilds', ephemeral=True)
+
+@client.tree.command()
+@app_commands.default_permissions(administrator=True)
+async def stats(interaction: discord.Interaction):
+    """Shows counts and latencies of commands, buttons and Discord calls since the bot started"""
+    logger.info(f'{interaction.user.display_name} called /stats')
+    summary = METRICS.summary()
+    if len(summary) > 1990:
+        summary = summary[:1990].rsplit('\n', 1)[0]
+    await interaction.response.send_message(f'```\n{summary}\n```', ephemeral=True)
+
 @client.tree.command()
 async def help(interaction: discord.Interaction, page: app_commands.Range[int, 1, 2]):
     """Lists all commands with explanation about what they do, page 1 or 2"""
@@ -328,4 +423,6 @@ async def help(interaction: discord.Interaction, page: app_commands.Range[int, 1
     await interaction.response.send_message(DOCUMENTATION_STRINGS[index], ephemeral=True, delete_after=180)
 
 
-client.run(TOKEN)
+if __name__ == '__main__':
+    TOKEN = load_token_from_file(TOKEN_PATH)
+    client.run(TOKEN)
@@ -0,0 +1,162 @@
+from logger import logger
+from typing import Callable
+import asyncio
+import functools
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls in, good enough to spot slow handlers
+        wanted = q * self.count
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            if count >= wanted:
+                return bound
+        return float('inf')
+
+
+class Timed:
+    def __init__(self, metrics: 'Metrics', name: str, labels: Labels) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.histograms.setdefault((self.name, self.labels), Histogram()).observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            key = (f'{self.name}_errors_total', self.labels)
+            self.metrics.counters[key] = self.metrics.counters.get(key, 0) + 1
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.gauges: dict[str, Callable[[], dict[Labels, float]]] = {}
+
+    @staticmethod
+    def labels(labels: dict[str, str]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, self.labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        self.histograms.setdefault((name, self.labels(labels)), Histogram()).observe(seconds)
+
+    def timed(self, name: str, **labels) -> Timed:
+        return Timed(self, name, self.labels(labels))
+
+    def gauge(self, name: str, collect: Callable[[], dict[Labels, float] | float]) -> None:
+        self.gauges[name] = collect
+
+    @staticmethod
+    def format_labels(labels: Labels, extra: str = '') -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def collect_gauges(self) -> dict[str, dict[Labels, float]]:
+        gauges = {}
+        for name, collect in self.gauges.items():
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f'Collecting gauge {name} failed:\n{e}')
+                continue
+            gauges[name] = values if isinstance(values, dict) else {(): values}
+        return gauges
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'botc_{name}{self.format_labels(labels)} {value}')
+        for name, values in sorted(self.collect_gauges().items()):
+            for labels, value in values.items():
+                lines.append(f'botc_{name}{self.format_labels(labels)} {value}')
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), (*histogram.buckets, histogram.count)):
+                bucket_labels = self.format_labels(labels, f'le="{bound}"')
+                lines.append(f'botc_{name}_bucket{bucket_labels} {count}')
+            lines.append(f'botc_{name}_sum{self.format_labels(labels)} {histogram.sum}')
+            lines.append(f'botc_{name}_count{self.format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: -item[1].sum):
+            label = ' '.join(value for _, value in labels)
+            lines.append(f'{name} {label}: {histogram.count}x, avg {histogram.sum / histogram.count * 1000:.0f}ms, p95 <= {histogram.quantile(0.95) * 1000:.0f}ms')
+        for (name, labels), value in sorted(self.counters.items()):
+            label = ' '.join(value for _, value in labels)
+            lines.append(f'{name} {label}: {value:.0f}')
+        for name, values in sorted(self.collect_gauges().items()):
+            for labels, value in values.items():
+                label = ' '.join(value for _, value in labels)
+                lines.append(f'{name} {label}: {value:g}')
+        return '\n'.join(lines) or 'No metrics recorded yet'
+
+
+METRICS = Metrics()
+
+
+def instrumented(handler: str):
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            async with METRICS.timed('handler_seconds', handler=handler):
+                return await callback(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            body = METRICS.render().encode()
+            status = '200 OK'
+        else:
+            body = b'Not found\n'
+            status = '404 Not Found'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str, port: int) -> asyncio.AbstractServer:
+    server = await asyncio.start_server(handle_metrics_request, host, port)
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
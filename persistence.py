@@ -0,0 +1,132 @@
+from logger import logger, SAMPLED
+from global_vars import FLUSH_INTERVAL
+from metrics import METRICS
+from pathlib import Path
+from collections import Counter
+from typing import Callable, Hashable
+import asyncio
+import os
+import time
+
+Job = Callable[[], None]
+
+
+def write_atomic(path: Path, data: str) -> None:
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def run_jobs(jobs: dict[Hashable, Job]) -> dict[Hashable, Exception]:
+    failures = {}
+    for key, job in jobs.items():
+        try:
+            job()
+        except Exception as e:
+            failures[key] = e
+    return failures
+
+
+class WriteBehind:
+    # Collects dirty state keyed by what it writes to, so a burst of saves of the same
+    # guild becomes a single write. prepare() runs on the event loop at flush time and
+    # returns the blocking job that is then run in a worker thread.
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.pending: dict[Hashable, Callable[[], Job]] = {}
+        # Owner of every pending or running write and how many it has, so the Database of a
+        # guild is not dropped from memory while its last changes are not on disk yet
+        self.owners: dict[Hashable, Hashable] = {}
+        self.unwritten: Counter[Hashable] = Counter()
+        self.task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+        self.last_flush_latency = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    def has_unwritten(self, owner: Hashable) -> bool:
+        return owner in self.unwritten
+
+    def release(self, owner: Hashable) -> None:
+        self.unwritten[owner] -= 1
+        if self.unwritten[owner] <= 0:
+            del self.unwritten[owner]
+
+    def mark_dirty(self, key: Hashable, prepare: Callable[[], Job], owner: Hashable | None = None) -> None:
+        if owner is not None and key not in self.pending:
+            self.owners[key] = owner
+            self.unwritten[owner] += 1
+        self.pending[key] = prepare
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def _take_batch(self) -> tuple[dict[Hashable, Callable[[], Job]], dict[Hashable, Job]]:
+        batch, self.pending = self.pending, {}
+        return batch, {key: prepare() for key, prepare in batch.items()}
+
+    def _release_batch(self, batch: dict, failures: dict) -> None:
+        for key in batch:
+            owner = self.owners.get(key)
+            if owner is None:
+                continue
+            if key in self.pending:
+                # A newer write of the same key was queued meanwhile and counts on its own
+                self.release(owner)
+            elif key not in failures:
+                del self.owners[key]
+                self.release(owner)
+            # A failed write is queued again below and stays unwritten
+
+    def _record(self, batch: dict, failures: dict, started: float) -> None:
+        latency = time.perf_counter() - started
+        self.last_flush_latency = latency
+        METRICS.observe('storage_seconds', latency, operation='write')
+        METRICS.inc('storage_writes_total', len(batch) - len(failures))
+        METRICS.inc('storage_write_failures_total', len(failures))
+        self._release_batch(batch, failures)
+        for key, e in failures.items():
+            logger.error(f'Failed to write {key}, will retry on next flush:\n{e}')
+            self.pending.setdefault(key, batch[key])
+        logger.debug(f'Flushed {len(batch)} pending writes in {latency * 1000:.1f}ms, {self.queue_depth} still queued', extra=SAMPLED)
+        if latency > self.interval:
+            logger.warning(f'Flushing took {latency:.2f}s which is longer than the {self.interval}s flush interval')
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pending:
+                return
+            batch, jobs = self._take_batch()
+            started = time.perf_counter()
+            failures = await asyncio.to_thread(run_jobs, jobs)
+            self._record(batch, failures, started)
+
+    def flush_sync(self) -> None:
+        if not self.pending:
+            return
+        batch, jobs = self._take_batch()
+        started = time.perf_counter()
+        failures = run_jobs(jobs)
+        self._record(batch, failures, started)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+
+WRITER = WriteBehind(FLUSH_INTERVAL)
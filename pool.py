@@ -0,0 +1,144 @@
+from logger import logger
+from global_vars import POOL_NIGHT_CHANNELS
+from database import Database, get_database
+from purge import purge_channel
+from actions import Priority, enqueue, rest_call
+from channels import ChannelPlan, ProvisioningError, day_overwrites, night_overwrites, provision_game_channels, delete_channels
+import asyncio
+import discord
+import time
+
+# Running refills per guild id, so a guild never builds more than one set at a time
+REFILLS: dict[int, asyncio.Task] = {}
+
+
+class ChannelPool:
+    # Pre-built day/night category sets owned by the bot. The state lives in the guild
+    # Database under "channel_pool" so the pool survives restarts.
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.guild = database.guild
+        self.state = database.dict.setdefault("channel_pool", {"low": 0, "high": 0, "sets": [], "claimed": [], "next_number": 1})
+
+    @property
+    def enabled(self) -> bool:
+        return self.state["high"] > 0
+
+    @property
+    def sets(self) -> list[dict]:
+        return self.state["sets"]
+
+    def save(self):
+        self.database.save('meta', 'channel_pool')
+
+    def configure(self, low: int, high: int) -> None:
+        self.state["low"] = low
+        self.state["high"] = high
+        self.save()
+        self.schedule_refill()
+
+    def next_number(self) -> int:
+        # Set numbers only go up, a released set never takes the name of one that still exists.
+        # Pools saved before the counter start after the sets they have
+        number = self.state.setdefault("next_number", len(self.sets) + len(self.state["claimed"]) + 1)
+        self.state["next_number"] = number + 1
+        return number
+
+    def is_claimed(self, day_category_id: int) -> bool:
+        return any(pooled_set["day_category"] == day_category_id for pooled_set in self.state["claimed"])
+
+    def categories(self, pooled_set: dict) -> tuple[discord.CategoryChannel | None, discord.CategoryChannel | None]:
+        return self.guild.get_channel(pooled_set["day_category"]), self.guild.get_channel(pooled_set["night_category"])
+
+    def edit(self, channel: discord.abc.GuildChannel, **kwargs) -> asyncio.Future:
+        return enqueue(self.guild, Priority.CHANNEL, rest_call('edit_channel', lambda: channel.edit(**kwargs)), ('edit_channel', channel.id))
+
+    @staticmethod
+    def town_square(day_category: discord.CategoryChannel) -> discord.VoiceChannel | None:
+        return discord.utils.find(lambda channel: channel.name.startswith('Town Square'), day_category.voice_channels)
+
+    async def claim(self, plan: ChannelPlan) -> tuple[discord.CategoryChannel, discord.CategoryChannel] | None:
+        while self.sets:
+            pooled_set = self.sets.pop(0)
+            day_category, night_category = self.categories(pooled_set)
+            if day_category is None or night_category is None:
+                logger.warning(f'Pooled channel set {pooled_set} no longer exists, dropping it from the pool')
+                continue
+            if len(night_category.voice_channels) < len(plan.night_channel_names):
+                self.sets.append(pooled_set)
+                break
+            self.state["claimed"].append(pooled_set)
+            self.save()
+            town_square = self.town_square(day_category)
+            renames = [self.edit(day_category, name=plan.day_category_name), self.edit(night_category, name=plan.night_category_name)]
+            if town_square:
+                renames.append(self.edit(town_square, name=plan.day_channel_names[-1]))
+            await asyncio.gather(*renames)
+            logger.info(f'Claimed pooled channel set as {plan.day_category_name} and {plan.night_category_name}, {len(self.sets)} sets left')
+            self.schedule_refill()
+            return day_category, night_category
+        self.schedule_refill()
+        return None
+
+    async def release(self, day_category_id: int) -> None:
+        pooled_set = next(pooled_set for pooled_set in self.state["claimed"] if pooled_set["day_category"] == day_category_id)
+        self.state["claimed"].remove(pooled_set)
+        self.save()
+        day_category, night_category = self.categories(pooled_set)
+        if day_category is None or night_category is None:
+            logger.warning(f'Released pooled channel set {pooled_set} no longer exists')
+            return
+        if len(self.sets) >= self.state["high"]:
+            logger.info(f'Channel pool of {self.guild.name} is full, deleting {day_category.name} and {night_category.name}')
+            await delete_channels(self.database, [day_category, night_category])
+            return
+        await self.reset(day_category, night_category)
+        self.sets.append(pooled_set)
+        self.save()
+        logger.info(f'Returned {day_category.name} and {night_category.name} to the channel pool of {self.guild.name}')
+
+    async def reset(self, day_category: discord.CategoryChannel, night_category: discord.CategoryChannel) -> None:
+        number = self.next_number()
+        resets = [
+            self.edit(day_category, name=f'Pooled Game {number}', overwrites=day_overwrites(self.guild)),
+            self.edit(night_category, name=f'Pooled Night {number}', overwrites=night_overwrites(self.guild)),
+        ]
+        town_square = self.town_square(day_category)
+        if town_square:
+            resets.append(self.edit(town_square, name='Town Square (pooled)'))
+        game_chat = discord.utils.get(day_category.text_channels, name='game-chat')
+        if game_chat:
+            resets.append(purge_channel(game_chat))
+        await asyncio.gather(*resets)
+
+    def schedule_refill(self) -> None:
+        if len(self.sets) >= self.state["low"] or self.guild.id in REFILLS:
+            return
+        task = asyncio.get_running_loop().create_task(self.refill())
+        REFILLS[self.guild.id] = task
+        task.add_done_callback(lambda _: REFILLS.pop(self.guild.id, None))
+
+    async def refill(self) -> None:
+        started = time.perf_counter()
+        built = 0
+        while len(self.sets) < self.state["high"]:
+            number = self.next_number()
+            plan = ChannelPlan('Pool', POOL_NIGHT_CHANNELS)
+            plan.day_category_name = f'Pooled Game {number}'
+            plan.night_category_name = f'Pooled Night {number}'
+            plan.day_channel_names[-1] = 'Town Square (pooled)'
+            try:
+                day_category, night_category, _ = await provision_game_channels(self.guild, plan)
+            except ProvisioningError as e:
+                logger.error(f'Could not refill the channel pool of {self.guild.name}:\n{e}')
+                return
+            self.sets.append({"day_category": day_category.id, "night_category": night_category.id})
+            self.save()
+            built += 1
+        logger.info(f'Refilled the channel pool of {self.guild.name} with {built} sets in {time.perf_counter() - started:.2f}s')
+
+
+async def release_game_channels(guild: discord.Guild, game: dict) -> None:
+    pool = ChannelPool(get_database(guild))
+    if pool.is_claimed(game["day_category"][0]):
+        await pool.release(game["day_category"][0])
@@ -0,0 +1,82 @@
+from logger import logger
+from global_vars import OLD_MESSAGE_DELETE_INTERVAL
+from fanout import ProgressCallback
+from actions import Priority, enqueue, rest_call
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+import asyncio
+import discord
+import time
+
+# Discord only bulk deletes up to 100 messages at once and only messages younger than 14 days
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+
+# Background jobs deleting messages that are too old to bulk delete
+OLD_MESSAGE_JOBS: set[asyncio.Task] = set()
+
+
+class PurgeReport:
+    def __init__(self) -> None:
+        self.bulk_deleted = 0
+        self.old_messages = 0
+        self.elapsed = 0.0
+
+    def summary(self, channel_name: str) -> str:
+        summary = f'Deleted {self.bulk_deleted} messages from {channel_name} in {self.elapsed:.2f}s'
+        if self.old_messages:
+            summary += f', deleting {self.old_messages} messages older than 14 days in the background'
+        return summary
+
+
+async def delete_old_messages(channel: discord.TextChannel, messages: list[discord.Message]) -> None:
+    started = time.perf_counter()
+    deleted = 0
+    for message in messages:
+        try:
+            await enqueue(channel.guild, Priority.COSMETIC, rest_call('delete_message', message.delete))
+            deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            logger.error(f'Could not delete old message {message.id} from {channel.name}:\n{e}')
+        await asyncio.sleep(OLD_MESSAGE_DELETE_INTERVAL)
+    logger.info(f'Deleted {deleted}/{len(messages)} old messages from {channel.name} in {time.perf_counter() - started:.2f}s')
+
+
+async def purge_channel(channel: discord.TextChannel, check: Callable[[discord.Message], bool] | None = None, after: datetime | None = None, on_progress: ProgressCallback | None = None) -> PurgeReport:
+    report = PurgeReport()
+    started = time.perf_counter()
+    cutoff = datetime.now(timezone.utc) - BULK_DELETE_MAX_AGE
+    batch: list[discord.Message] = []
+    old_messages: list[discord.Message] = []
+    seen = 0
+
+    async def delete_batch():
+        await enqueue(channel.guild, Priority.COSMETIC, rest_call('purge', lambda: channel.delete_messages(batch)))
+        report.bulk_deleted += len(batch)
+        batch.clear()
+        if on_progress:
+            await on_progress(report.bulk_deleted, seen)
+
+    async for message in channel.history(limit=None, after=after):
+        if check and not check(message):
+            continue
+        seen += 1
+        if message.created_at < cutoff:
+            old_messages.append(message)
+            continue
+        batch.append(message)
+        if len(batch) == BULK_DELETE_LIMIT:
+            await delete_batch()
+    if batch:
+        await delete_batch()
+
+    if old_messages:
+        report.old_messages = len(old_messages)
+        task = asyncio.get_running_loop().create_task(delete_old_messages(channel, old_messages))
+        OLD_MESSAGE_JOBS.add(task)
+        task.add_done_callback(OLD_MESSAGE_JOBS.discard)
+    report.elapsed = time.perf_counter() - started
+    logger.info(report.summary(channel.name))
+    return report
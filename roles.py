@@ -0,0 +1,42 @@
+import discord
+
+
+class RoleIndex:
+    # Roles of a guild by name and by id, built once from guild.roles and dropped by the
+    # role create, update and delete events so the next lookup rebuilds it. A name used by
+    # several roles resolves to the lowest of them, like discord.utils.get(guild.roles, name=...)
+    def __init__(self, guild: discord.Guild) -> None:
+        self.by_id: dict[int, discord.Role] = {}
+        self.by_name: dict[str, discord.Role] = {}
+        for role in guild.roles:
+            self.by_id[role.id] = role
+            self.by_name.setdefault(role.name, role)
+
+    def get(self, role_id: int | None) -> discord.Role | None:
+        return self.by_id.get(role_id)
+
+    def named(self, name: str) -> discord.Role | None:
+        return self.by_name.get(name)
+
+    def storyteller(self, storyteller_role_id: int | None) -> discord.Role | None:
+        # The role the Database remembers wins, so renaming it keeps it working
+        return self.get(storyteller_role_id) or self.named('Storyteller')
+
+
+ROLE_INDEXES: dict[int, RoleIndex] = {}
+
+
+def role_index(guild: discord.Guild) -> RoleIndex:
+    index = ROLE_INDEXES.get(guild.id)
+    if index is None:
+        index = ROLE_INDEXES[guild.id] = RoleIndex(guild)
+    return index
+
+
+def invalidate_role_index(guild_id: int) -> None:
+    ROLE_INDEXES.pop(guild_id, None)
+
+
+def has_role(member: discord.Member, role: discord.Role | None) -> bool:
+    # Member.get_role looks the id up in the member's sorted role ids instead of building Role objects
+    return role is not None and member.get_role(role.id) is not None
@@ -0,0 +1,88 @@
+from logger import logger
+from typing import Awaitable, Callable
+import asyncio
+import heapq
+import itertools
+import time
+
+Callback = Callable[[], Awaitable[None] | None]
+
+
+class ScheduledCall:
+    def __init__(self, deadline: float, callback: Callback) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    @property
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    # One task for every scheduled call in the process. Calls sit in a heap ordered by
+    # their monotonic deadline and the task only wakes up when the earliest one is due.
+    # Cancelled calls are left in the heap and skipped when they reach the top.
+    def __init__(self) -> None:
+        self.heap: list[tuple[float, int, ScheduledCall]] = []
+        self.counter = itertools.count()
+        self.task: asyncio.Task | None = None
+        self.wakeup: asyncio.Event | None = None
+        self.running: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return sum(1 for _, _, call in self.heap if not call.cancelled)
+
+    def call_at(self, deadline: float, callback: Callback) -> ScheduledCall:
+        call = ScheduledCall(deadline, callback)
+        self.push(call)
+        return call
+
+    def call_later(self, delay: float, callback: Callback) -> ScheduledCall:
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def push(self, call: ScheduledCall) -> None:
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (call.deadline, next(self.counter), call))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        elif earliest is None or call.deadline < earliest:
+            self.wakeup.set()
+
+    async def run(self):
+        while self.heap:
+            deadline, _, call = self.heap[0]
+            if call.cancelled:
+                heapq.heappop(self.heap)
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            self.fire(call)
+
+    def fire(self, call: ScheduledCall) -> None:
+        try:
+            result = call.callback()
+        except Exception as e:
+            logger.error(f'Scheduled call {call.callback} failed with error:\n{e}')
+            return
+        if asyncio.iscoroutine(result):
+            task = asyncio.get_running_loop().create_task(self.guard(result))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def guard(self, coroutine: Awaitable[None]):
+        try:
+            await coroutine
+        except Exception as e:
+            logger.error(f'Scheduled call failed with error:\n{e}')
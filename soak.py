@@ -0,0 +1,254 @@
+from logger import logger
+from fakes import FakeDiscord, FakeGame, FakeMember, FakeVoiceState
+from storage import JsonStorage
+from persistence import WRITER
+from classes import Timer
+from metrics import METRICS
+from benchmark import RunningGame, git_version, percentile
+from datetime import datetime
+from pathlib import Path
+import argparse
+import asyncio
+import database
+import json
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import time
+import main
+
+# Plays a whole game night against the real MyClient from main.py. Voice state updates are
+# fed through client.dispatch like the gateway would and clicks go through the real
+# GameControls callbacks, all against the fakes from fakes.py, so nothing leaves the machine.
+#   python soak.py --guilds 200 --scenario game_night.json --max-p95-ms 500
+# A scenario file is a list of phases run one after the other:
+#   [{"name": "peak", "duration": 60, "voice_rate": 200, "noise_ratio": 0.8, "click_interval": 20}]
+
+DEFAULT_SCENARIO = [
+    {"name": "warmup", "duration": 10, "voice_rate": 20, "noise_ratio": 0.8, "click_interval": 30},
+    {"name": "peak", "duration": 30, "voice_rate": 200, "noise_ratio": 0.8, "click_interval": 10},
+    {"name": "cooldown", "duration": 10, "voice_rate": 20, "noise_ratio": 0.8, "click_interval": 30},
+]
+LOOP_LAG_INTERVAL = 0.05
+
+
+class SoakGame(RunningGame):
+    # A running game of the benchmarks, played through the real MyClient and with spectators
+    def __init__(self, game: FakeGame, spectators: int) -> None:
+        super().__init__(game, main.client)
+        self.spectators: list[FakeMember] = []
+        for number in range(spectators):
+            spectator = game.guild.add_member(f'{game.guild.name} Spectator {number}')
+            self.database.spectators.link(spectator.id, game.storyteller.id)
+            spectator.join(game.town_square)
+            self.spectators.append(spectator)
+        self.night = False
+
+
+class Soak:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.fake_discord = FakeDiscord(args.latency, args.jitter)
+        self.games: list[SoakGame] = []
+        # Spectator id to the time its leader moved, until the spectator arrived
+        self.waiting: dict[int, float] = {}
+        self.follow_latencies: list[float] = []
+        self.click_latencies: list[float] = []
+        self.loop_lags: list[float] = []
+        self.emitted = 0
+        self.clicks = 0
+        self.phase: dict = {}
+
+    def setup(self) -> None:
+        for number in range(self.args.guilds):
+            game = FakeGame(self.fake_discord, f'Guild {number}', self.args.players)
+            game.guild.on_voice_state_update = self.on_move
+            game.seat_in_town_square()
+            self.games.append(SoakGame(game, self.args.spectators))
+        print(f'Set up {len(self.games)} guilds with {self.args.players} players and {self.args.spectators} spectators each')
+
+    def dispatch(self, member: FakeMember, before: FakeVoiceState, after: FakeVoiceState) -> None:
+        main.client.dispatch('voice_state_update', member, before, after)
+
+    async def on_move(self, member: FakeMember, before: FakeVoiceState, after: FakeVoiceState) -> None:
+        # Every move the bot makes comes back as a gateway event, like it does from Discord
+        started = self.waiting.pop(member.id, None)
+        if started is not None:
+            self.follow_latencies.append(time.perf_counter() - started)
+        self.dispatch(member, before, after)
+
+    def emit_voice_event(self) -> None:
+        self.emitted += 1
+        soak_game = random.choice(self.games)
+        game = soak_game.game
+        if random.random() < self.phase["noise_ratio"]:
+            # Mute, deafen and stream toggles keep the channel
+            member = random.choice(game.players + soak_game.spectators)
+            state = member.voice or FakeVoiceState(None)
+            self.dispatch(member, state, FakeVoiceState(state.channel))
+            return
+        channel = random.choice([channel for channel in game.day_channels + [game.town_square] if channel != game.storyteller.voice.channel])
+        now = time.perf_counter()
+        for spectator in soak_game.spectators:
+            if spectator.voice.channel != channel:
+                self.waiting.setdefault(spectator.id, now)
+        before = game.storyteller.join(channel)
+        self.dispatch(game.storyteller, before, game.storyteller.voice)
+
+    async def voice_storm(self, deadline: float) -> None:
+        sent = 0
+        started = time.monotonic()
+        while time.monotonic() < deadline:
+            if self.phase["voice_rate"] <= 0:
+                await asyncio.sleep(deadline - time.monotonic())
+                return
+            sent += 1
+            self.emit_voice_event()
+            # Paced against the start so a slow loop catches up instead of drifting
+            await asyncio.sleep(max(0.0, started + sent / self.phase["voice_rate"] - time.monotonic()))
+
+    async def click(self, soak_game: SoakGame) -> None:
+        game = soak_game.game
+        button = soak_game.view.day if soak_game.night else soak_game.view.night
+        started = time.perf_counter()
+        await button.callback(soak_game.interaction())
+        self.click_latencies.append(time.perf_counter() - started)
+        self.clicks += 1
+        soak_game.night = not soak_game.night
+        if not soak_game.night and self.args.timer and (game.guild.id, game.storyteller.id) not in main.client.timers:
+            timer = Timer(main.client, self.args.timer, game.game_chat, game.day_category, game.storyteller, game.town_square)
+            await timer.start()
+
+    async def storyteller(self, soak_game: SoakGame, deadline: float) -> None:
+        # Clicks Night and Day in turns, spread out so not every guild clicks at the same moment
+        await asyncio.sleep(random.uniform(0, self.phase["click_interval"]))
+        while time.monotonic() < deadline:
+            try:
+                await self.click(soak_game)
+            except Exception as e:
+                logger.error(f'Click in {soak_game.game.guild.name} failed:\n{e}')
+            await asyncio.sleep(self.phase["click_interval"] * random.uniform(0.5, 1.5))
+
+    async def measure_loop_lag(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lags.append(time.perf_counter() - started - LOOP_LAG_INTERVAL)
+
+    async def run_phase(self, phase: dict) -> dict:
+        self.phase = phase
+        deadline = time.monotonic() + phase["duration"]
+        follow_start, click_start, lag_start, events_start = len(self.follow_latencies), len(self.click_latencies), len(self.loop_lags), self.emitted
+        tasks = [self.voice_storm(deadline)]
+        if phase["click_interval"] > 0:
+            tasks.extend(self.storyteller(soak_game, deadline) for soak_game in self.games)
+        await asyncio.gather(*tasks)
+        result = {
+            "name": phase["name"],
+            "events_per_second": (self.emitted - events_start) / phase["duration"],
+            "follow": summarize(self.follow_latencies[follow_start:]),
+            "click": summarize(self.click_latencies[click_start:]),
+            "loop_lag": summarize(self.loop_lags[lag_start:]),
+        }
+        print(f'{phase["name"]}: {result["events_per_second"]:.0f} events/s, follow p95 {result["follow"]["p95_ms"]:.1f}ms, '
+              f'click p95 {result["click"]["p95_ms"]:.1f}ms, loop lag p95 {result["loop_lag"]["p95_ms"]:.1f}ms')
+        return result
+
+    async def run(self, scenario: list[dict]) -> dict:
+        # The client never logs in, dispatch only needs to know the loop to schedule handlers on
+        main.client.loop = asyncio.get_running_loop()
+        self.setup()
+        lag_monitor = asyncio.create_task(self.measure_loop_lag())
+        phases = [await self.run_phase(phase) for phase in scenario]
+        lag_monitor.cancel()
+        for timer in list(main.client.timers.values()):
+            timer.call.cancel()
+        main.client.timers.clear()
+        for soak_game in self.games:
+            soak_game.view.cancel_pending_edits()
+        return {
+            "version": git_version(),
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+            "settings": {key: str(value) if isinstance(value, Path) else value for key, value in vars(self.args).items()},
+            "phases": phases,
+            "follow": summarize(self.follow_latencies),
+            "click": summarize(self.click_latencies),
+            "loop_lag": summarize(self.loop_lags),
+            "voice_events_emitted": self.emitted,
+            "clicks": self.clicks,
+            "unfollowed": len(self.waiting),
+            "voice_events": dict(main.client.voice_event_counts),
+            "rest_calls": dict(self.fake_discord.calls),
+            "handlers": {
+                dict(labels)["handler"]: {"count": histogram.count, "mean_ms": histogram.sum / histogram.count * 1000, "p95_bucket_ms": histogram.quantile(0.95) * 1000}
+                for (name, labels), histogram in METRICS.histograms.items() if name == 'handler_seconds'
+            },
+        }
+
+
+def summarize(samples: list[float]) -> dict:
+    if not samples:
+        return {"samples": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "samples": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+def gate(report: dict, args: argparse.Namespace) -> list[str]:
+    problems = []
+    if args.max_p95_ms is not None and report["follow"]["p95_ms"] > args.max_p95_ms:
+        problems.append(f'spectator follow p95 {report["follow"]["p95_ms"]:.1f}ms is over {args.max_p95_ms}ms')
+    if args.max_p95_ms is not None and report["click"]["p95_ms"] > args.max_p95_ms:
+        problems.append(f'click p95 {report["click"]["p95_ms"]:.1f}ms is over {args.max_p95_ms}ms')
+    if args.max_loop_lag_ms is not None and report["loop_lag"]["p95_ms"] > args.max_loop_lag_ms:
+        problems.append(f'event loop lag p95 {report["loop_lag"]["p95_ms"]:.1f}ms is over {args.max_loop_lag_ms}ms')
+    return problems
+
+
+async def soak(args: argparse.Namespace, scenario: list[dict]) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        # Never touch the real databases
+        database.STORAGE = JsonStorage(Path(directory))
+        report = await Soak(args).run(scenario)
+        await WRITER.close()
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Soak tests MyClient with many fake guilds playing at the same time')
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--players', type=int, default=12)
+    parser.add_argument('--spectators', type=int, default=2, help='Spectators following the storyteller in every guild')
+    parser.add_argument('--timer', type=float, default=60, help='Seconds of the timer started after every Day click, 0 for none')
+    parser.add_argument('--scenario', type=Path, help='JSON list of phases, see the top of this file')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every fake Discord call takes')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Up to this many seconds are added to every call at random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=Path('soak.json'))
+    parser.add_argument('--max-p95-ms', type=float, help='Fail when the follow or click p95 latency is higher')
+    parser.add_argument('--max-loop-lag-ms', type=float, help='Fail when the p95 event loop lag is higher')
+    parser.add_argument('--verbose', action='store_true', help='Keep the bot logging at its normal level')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    if not args.verbose:
+        # Spectators sitting in Town Square make every Night warn about missing night channels
+        logger.setLevel(logging.ERROR)
+    scenario = json.loads(args.scenario.read_text()) if args.scenario else DEFAULT_SCENARIO
+    report = asyncio.run(soak(args, scenario))
+    args.output.write_text(json.dumps(report, indent=4))
+    print(f'Wrote soak report to {args.output}')
+    problems = gate(report, args)
+    for problem in problems:
+        print(f'FAILED: {problem}')
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,46 @@
+class SpectatorIndex:
+    # Keeps leader -> spectators and spectator -> leader in sync so every lookup is a
+    # dictionary hit. Spectators of a leader are kept in a dict to preserve link order.
+    def __init__(self, linked_players: dict[int, list[int]] | None = None) -> None:
+        self.followers: dict[int, dict[int, None]] = {}
+        self.following: dict[int, int] = {}
+        for leader, spectators in (linked_players or {}).items():
+            for spectator in spectators:
+                self.link(spectator, leader)
+
+    def __bool__(self) -> bool:
+        return bool(self.following)
+
+    def leader_of(self, spectator: int) -> int | None:
+        return self.following.get(spectator)
+
+    def spectators_of(self, leader: int) -> list[int]:
+        return list(self.followers.get(leader, ()))
+
+    def has_spectators(self, leader: int) -> bool:
+        return leader in self.followers
+
+    def would_create_cycle(self, spectator: int, leader: int) -> bool:
+        while leader is not None:
+            if leader == spectator:
+                return True
+            leader = self.following.get(leader)
+        return False
+
+    def link(self, spectator: int, leader: int) -> None:
+        self.unlink(spectator)
+        self.following[spectator] = leader
+        self.followers.setdefault(leader, {})[spectator] = None
+
+    def unlink(self, spectator: int) -> int | None:
+        leader = self.following.pop(spectator, None)
+        if leader is None:
+            return None
+        spectators = self.followers[leader]
+        del spectators[spectator]
+        if not spectators:
+            del self.followers[leader]
+        return leader
+
+    def to_dict(self) -> dict[int, list[int]]:
+        return {leader: list(spectators) for leader, spectators in self.followers.items()}
@@ -0,0 +1,196 @@
+from logger import logger
+from global_vars import DATABASE_DIR, STORAGE_BACKEND, SQLITE_PATH
+from persistence import WRITER, write_atomic
+from functools import partial
+from pathlib import Path
+import json
+import sqlite3
+import sys
+
+# Keys of a guild dict that are stored in their own tables, everything else is guild metadata
+ROW_TABLES = ('games', 'linked_players')
+
+
+class JsonStorage:
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        # File of every loaded guild, worked out once on load so saves touch no disk on the loop
+        self.paths: dict[int, Path] = {}
+
+    def path(self, guild_id: int, guild_name: str) -> Path:
+        path = self.directory / f'{guild_name}_{guild_id}.json'
+        if path.exists():
+            return path
+        for old_path in self.directory.glob(f'*_{guild_id}.json'):
+            logger.info(f'Guild {guild_id} was renamed, moving {old_path.name} to {path.name}')
+            old_path.rename(path)
+            break
+        return path
+
+    def load(self, guild_id: int, guild_name: str) -> dict | None:
+        path = self.paths[guild_id] = self.path(guild_id, guild_name)
+        if not path.exists():
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def write(self, database, table: str | None = None, key: str | int | None = None) -> None:
+        # A JSON file can only be rewritten as a whole, so every change dirties the guild
+        path = self.paths.get(database.guild.id) or self.directory / f'{database.guild_name}_{database.guild.id}.json'
+        WRITER.mark_dirty(path, lambda: partial(write_atomic, path, json.dumps(database.dict, indent=2)), database.guild.id)
+
+
+class SqliteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guild_meta (
+            guild_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS games (
+            guild_id INTEGER NOT NULL,
+            owner TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (guild_id, owner)
+        );
+        CREATE TABLE IF NOT EXISTS linked_players (
+            guild_id INTEGER NOT NULL,
+            spectator TEXT NOT NULL,
+            leader TEXT NOT NULL,
+            PRIMARY KEY (guild_id, spectator)
+        );
+        CREATE INDEX IF NOT EXISTS linked_players_leader ON linked_players (guild_id, leader);
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        # Reads happen on the event loop, writes in the WRITER thread, each on its own connection
+        self.reader = self.connect()
+        self.writer = self.connect(check_same_thread=False)
+        self.writer.executescript(self.SCHEMA)
+
+    def connect(self, **kwargs) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, isolation_level=None, **kwargs)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        return connection
+
+    def load(self, guild_id: int, guild_name: str) -> dict | None:
+        meta = self.reader.execute('SELECT key, value FROM guild_meta WHERE guild_id = ?', (guild_id,)).fetchall()
+        if not meta:
+            return None
+        guild_dict = {key: json.loads(value) for key, value in meta}
+        guild_dict["games"] = {
+            owner: json.loads(data)
+            for owner, data in self.reader.execute('SELECT owner, data FROM games WHERE guild_id = ?', (guild_id,))
+        }
+        linked_players = {}
+        for spectator, leader in self.reader.execute('SELECT spectator, leader FROM linked_players WHERE guild_id = ?', (guild_id,)):
+            linked_players.setdefault(leader, []).append(spectator)
+        guild_dict["linked_players"] = linked_players
+        return guild_dict
+
+    def write(self, database, table: str | None = None, key: str | int | None = None) -> None:
+        guild_id = database.guild.id
+        if table is None:
+            WRITER.mark_dirty(('guild', guild_id), lambda: partial(self.write_guild, guild_id, json.loads(json.dumps(database.dict))), guild_id)
+        elif table == 'games':
+            WRITER.mark_dirty((table, guild_id, key), lambda: partial(self.write_game, guild_id, key, self.dumps(database.games.get(key))), guild_id)
+        elif table == 'linked_players':
+            WRITER.mark_dirty((table, guild_id, key), lambda: partial(self.write_spectator, guild_id, key, database.spectators.leader_of(key)), guild_id)
+        else:
+            WRITER.mark_dirty((table, guild_id, key), lambda: partial(self.write_meta, guild_id, key, self.dumps(database.dict.get(key))), guild_id)
+
+    @staticmethod
+    def dumps(value) -> str | None:
+        return None if value is None else json.dumps(value)
+
+    def write_meta(self, guild_id: int, key: str, value: str | None) -> None:
+        if value is None:
+            self.writer.execute('DELETE FROM guild_meta WHERE guild_id = ? AND key = ?', (guild_id, key))
+            return
+        self.writer.execute('INSERT OR REPLACE INTO guild_meta (guild_id, key, value) VALUES (?, ?, ?)', (guild_id, key, value))
+
+    def write_game(self, guild_id: int, owner: int, data: str | None) -> None:
+        if data is None:
+            self.writer.execute('DELETE FROM games WHERE guild_id = ? AND owner = ?', (guild_id, owner))
+            return
+        self.writer.execute('INSERT OR REPLACE INTO games (guild_id, owner, data) VALUES (?, ?, ?)', (guild_id, owner, data))
+
+    def write_spectator(self, guild_id: int, spectator: int, leader: int | None) -> None:
+        if leader is None:
+            self.writer.execute('DELETE FROM linked_players WHERE guild_id = ? AND spectator = ?', (guild_id, spectator))
+            return
+        self.writer.execute('INSERT OR REPLACE INTO linked_players (guild_id, spectator, leader) VALUES (?, ?, ?)', (guild_id, spectator, leader))
+
+    def write_spectators(self, guild_id: int, leader: int, spectators: list[int]) -> None:
+        with self.transaction():
+            self.writer.execute('DELETE FROM linked_players WHERE guild_id = ? AND leader = ?', (guild_id, leader))
+            self.writer.executemany(
+                'INSERT OR REPLACE INTO linked_players (guild_id, spectator, leader) VALUES (?, ?, ?)',
+                [(guild_id, spectator, leader) for spectator in spectators])
+
+    def write_guild(self, guild_id: int, guild_dict: dict) -> None:
+        with self.transaction():
+            for table in ('guild_meta', *ROW_TABLES):
+                self.writer.execute(f'DELETE FROM {table} WHERE guild_id = ?', (guild_id,))
+            for key, value in guild_dict.items():
+                if key not in ROW_TABLES:
+                    self.write_meta(guild_id, key, json.dumps(value))
+            for owner, game in guild_dict.get("games", {}).items():
+                self.write_game(guild_id, owner, json.dumps(game))
+            for leader, spectators in guild_dict.get("linked_players", {}).items():
+                self.write_spectators(guild_id, leader, spectators)
+
+    def transaction(self):
+        return Transaction(self.writer)
+
+
+class Transaction:
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        self.depth = 0
+
+    def __enter__(self):
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN')
+            self.depth = 1
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.depth:
+            return
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def import_json_databases(storage: SqliteStorage, directory: Path = DATABASE_DIR) -> int:
+    imported = 0
+    for path in sorted(directory.glob('*.json')):
+        with open(path, 'r') as f:
+            guild_dict = json.load(f)
+        guild_id = guild_dict["guild"]["id"]
+        logger.info(f'Importing {path.name} into {storage.path.name}')
+        storage.write_guild(guild_id, guild_dict)
+        imported += 1
+    logger.info(f'Imported {imported} guild databases from {directory}')
+    return imported
+
+
+def create_storage(backend: str):
+    if backend == 'sqlite':
+        return SqliteStorage(SQLITE_PATH)
+    if backend == 'json':
+        return JsonStorage(DATABASE_DIR)
+    raise ValueError(f'Unknown storage backend {backend}, use "json" or "sqlite"')
+
+
+STORAGE = create_storage(STORAGE_BACKEND)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['import-json']:
+        print(f'Usage: python {Path(__file__).name} import-json')
+        exit(1)
+    import_json_databases(SqliteStorage(SQLITE_PATH))
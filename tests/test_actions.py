@@ -0,0 +1,56 @@
+from fakes import FakeDiscord, FakeGuild
+from actions import ActionQueue, Priority, enqueue
+from global_vars import CHANNEL_CONCURRENCY, COSMETIC_CONCURRENCY
+import asyncio
+
+
+def test_superseded_action_gives_its_waiters_the_newer_result():
+    async def supersede():
+        guild = FakeGuild(FakeDiscord(latency=0), 'Guild')
+        calls = []
+
+        async def move(channel: str):
+            calls.append(channel)
+            return channel
+
+        # Both are queued before a worker runs, so the first move never happens
+        first = enqueue(guild, Priority.MOVE, lambda: move('Town Square'), ('move', 1))
+        second = enqueue(guild, Priority.MOVE, lambda: move('Cottage 1'), ('move', 1))
+        assert await first == 'Cottage 1'
+        assert await second == 'Cottage 1'
+        assert calls == ['Cottage 1']
+
+    asyncio.run(supersede())
+
+
+def test_move_is_not_held_behind_busy_channel_and_cosmetic_lanes():
+    async def move_past_busy_lanes():
+        guild = FakeGuild(FakeDiscord(latency=0), 'Guild')
+        released = asyncio.Event()
+
+        async def blocked():
+            await released.wait()
+
+        busy = [enqueue(guild, Priority.CHANNEL, blocked) for _ in range(CHANNEL_CONCURRENCY + 1)]
+        busy += [enqueue(guild, Priority.COSMETIC, blocked) for _ in range(COSMETIC_CONCURRENCY + 1)]
+        move = enqueue(guild, Priority.MOVE, lambda: asyncio.sleep(0, 'moved'))
+        assert await asyncio.wait_for(move, 1) == 'moved'
+        assert not any(future.done() for future in busy)
+        released.set()
+        await asyncio.gather(*busy)
+
+    asyncio.run(move_past_busy_lanes())
+
+
+def test_paused_lane_starts_again_after_the_pause():
+    async def pause_and_resume():
+        queue = ActionQueue(1)
+        queue.pause(queue.urgent, 0.05)
+        move = queue.submit(Priority.MOVE, None, lambda: asyncio.sleep(0, 'moved'))
+        cosmetic = queue.submit(Priority.COSMETIC, None, lambda: asyncio.sleep(0, 'edited'))
+        # Other lanes keep going while one is paused
+        assert await cosmetic == 'edited'
+        assert not move.done()
+        assert await asyncio.wait_for(move, 1) == 'moved'
+
+    asyncio.run(pause_and_resume())
@@ -0,0 +1,60 @@
+from fakes import FakeDiscord, FakeGame
+from storage import JsonStorage
+from persistence import WRITER
+import asyncio
+import database
+import json
+
+
+def test_evicted_guild_is_reloaded_with_its_unwritten_changes(tmp_path, monkeypatch):
+    # An ended game must not come back when its guild is evicted before the write-behind flushed
+    monkeypatch.setattr(database, 'STORAGE', JsonStorage(tmp_path))
+    monkeypatch.setattr(database, 'DATABASE_CACHE_SIZE', 1)
+    monkeypatch.setattr(database, 'DATABASES', database.DATABASES.__class__())
+
+    async def evict_and_reload():
+        fake_discord = FakeDiscord(latency=0)
+        first, second, third = (FakeGame(fake_discord, name, 5) for name in ('First', 'Second', 'Third'))
+        first_database = database.get_database(first.guild)
+        first_database.games[first.storyteller.id] = first.game_dict(1)
+        first_database.save('games', first.storyteller.id)
+        await WRITER.flush()
+
+        first_database.games.pop(first.storyteller.id)
+        first_database.save('games', first.storyteller.id)
+        database.get_database(second.guild)
+        assert database.get_database(first.guild).games == {}
+
+        await WRITER.flush()
+        database.get_database(third.guild)
+        assert first.guild.id not in database.DATABASES
+        assert database.get_database(first.guild).games == {}
+        await WRITER.close()
+
+    asyncio.run(evict_and_reload())
+
+
+def test_members_missing_from_the_cache_are_migrated_once_they_are_found(tmp_path, monkeypatch):
+    storage = JsonStorage(tmp_path)
+    monkeypatch.setattr(database, 'STORAGE', storage)
+    monkeypatch.setattr(database, 'DATABASES', database.DATABASES.__class__())
+    game = FakeGame(FakeDiscord(latency=0), 'Guild', 5)
+    spectator = game.players[0]
+    storage.path(game.guild.id, game.guild.name).write_text(json.dumps({
+        "guild": {"name": game.guild.name, "id": game.guild.id, "categories": {}, "roles": {}},
+        "games": {"Away Storyteller": game.game_dict(1)},
+        "linked_players": {"Away Storyteller": [spectator.display_name]},
+        "storyteller_role_id": None,
+    }))
+
+    first_load = database.Database(game.guild)
+    WRITER.flush_sync()
+    assert first_load.games == {}
+    assert json.loads(storage.path(game.guild.id, game.guild.name).read_text()).get('schema_version', 1) == 1
+
+    storyteller = game.guild.add_member('Away Storyteller')
+    second_load = database.Database(game.guild)
+    WRITER.flush_sync()
+    assert list(second_load.games) == [storyteller.id]
+    assert second_load.spectators.leader_of(spectator.id) == storyteller.id
+    assert json.loads(storage.path(game.guild.id, game.guild.name).read_text())["schema_version"] == database.SCHEMA_VERSION
@@ -0,0 +1,65 @@
+from fakes import FakeDiscord, FakeGame
+from storage import SqliteStorage, import_json_databases
+from persistence import WRITER
+import database
+import json
+
+
+def test_sqlite_storage_saves_and_reloads_a_guild(tmp_path, monkeypatch):
+    storage = SqliteStorage(tmp_path / 'botc.sqlite3')
+    monkeypatch.setattr(database, 'STORAGE', storage)
+    game = FakeGame(FakeDiscord(latency=0), 'Guild', 5)
+    storyteller, spectator = game.storyteller, game.players[0]
+
+    first_load = database.Database(game.guild)
+    first_load.games[storyteller.id] = game.game_dict(1)
+    first_load.save('games', storyteller.id)
+    first_load.spectators.link(spectator.id, storyteller.id)
+    first_load.save('linked_players', spectator.id)
+    WRITER.flush_sync()
+    second_load = database.Database(game.guild)
+    assert second_load.games == {storyteller.id: first_load.games[storyteller.id]}
+    assert second_load.spectators.leader_of(spectator.id) == storyteller.id
+
+    second_load.spectators.unlink(spectator.id)
+    second_load.save('linked_players', spectator.id)
+    WRITER.flush_sync()
+    third_load = database.Database(game.guild)
+    assert third_load.spectators.leader_of(spectator.id) is None
+    assert list(third_load.games) == [storyteller.id]
+
+    third_load.games.clear()
+    third_load.storyteller_role_id = 42
+    third_load.save()
+    WRITER.flush_sync()
+    fourth_load = database.Database(game.guild)
+    assert fourth_load.games == {}
+    assert fourth_load.storyteller_role_id == 42
+    assert fourth_load.dict["guild"]["id"] == game.guild.id
+
+
+def test_schema_1_json_databases_are_imported_and_migrated(tmp_path, monkeypatch):
+    storage = SqliteStorage(tmp_path / 'botc.sqlite3')
+    monkeypatch.setattr(database, 'STORAGE', storage)
+    game = FakeGame(FakeDiscord(latency=0), 'Guild', 5)
+    storyteller, spectator = game.storyteller, game.players[0]
+    json_dir = tmp_path / 'databases'
+    json_dir.mkdir()
+    (json_dir / f'{game.guild.name}_{game.guild.id}.json').write_text(json.dumps({
+        "guild": {"name": game.guild.name, "id": game.guild.id, "categories": {}, "roles": {}},
+        "games": {storyteller.display_name: game.game_dict(1)},
+        "linked_players": {storyteller.display_name: [spectator.display_name]},
+        "storyteller_role_id": None,
+    }))
+
+    assert import_json_databases(storage, json_dir) == 1
+    migrated = database.Database(game.guild)
+    WRITER.flush_sync()
+    assert list(migrated.games) == [storyteller.id]
+    assert migrated.spectators.leader_of(spectator.id) == storyteller.id
+
+    reloaded = database.Database(game.guild)
+    assert reloaded.dict["schema_version"] == database.SCHEMA_VERSION
+    assert "unmigrated" not in reloaded.dict
+    assert list(reloaded.games) == [storyteller.id]
+    assert reloaded.spectators.leader_of(spectator.id) == storyteller.id
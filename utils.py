@@ -1,9 +1,13 @@
 from pathlib import Path
 from logger import logger
 import discord
-from global_vars import ROOMS_COUNT, ROOMS
-from database import Database
+from global_vars import ROOMS_COUNT, ROOMS, VIEW_EDIT_INTERVAL
+from fanout import ProgressCallback
+from typing import Callable
 import random
+import hashlib
+import json
+import time
 
 def load_token_from_file(file: Path) -> str:
     if not file.exists():
@@ -17,14 +21,14 @@ def load_token_from_file(file: Path) -> str:
     logger.critical(f'Token file {file} seems to be empty, please add the token to the file')
     exit(1)
 
-def is_owner(interaction: discord.Interaction, view_id: int) -> bool:
-    user_that_clicked = interaction.user.display_name
-    database = Database(interaction.guild)
-    if user_that_clicked in database.games:
-        user_is_owner = True if database.games[user_that_clicked]["view_id"] == view_id else False
-        if user_is_owner:
-            return True
-        logger.warning(f"{user_that_clicked} clicked on button it has no rights to!")
+# custom_id of every control panel item to the guild and storyteller of its game, filled
+# by GameControls for running games so a click is checked without loading the Database
+VIEW_OWNERS: dict[str, tuple[int, int]] = {}
+
+def is_owner(interaction: discord.Interaction, custom_id: str) -> bool:
+    if VIEW_OWNERS.get(custom_id) == (interaction.guild.id, interaction.user.id):
+        return True
+    logger.warning(f"{interaction.user.display_name} clicked on button it has no rights to!")
     return False
 
 def pick_random_channel_names(amount_of_rooms: int) -> list[str]:
@@ -47,21 +51,25 @@ def dict_to_str(dict: dict) -> str:
             string += f'  - {value}\n'
     return string
 
-def get_storyteller_role(guild: discord.Guild) -> discord.Role:
-    roles = guild.roles
-    storyteller_role = None
-    for role in roles:
-        if role.name == 'Storyteller':
-            storyteller_role = role
-    return storyteller_role
-
-def check_if_user_has_story_teller_role(interaction: discord.Interaction) -> bool:
-    user_has_story_teller_role = False
-    for role in interaction.user.roles:
-        if role.name == 'Storyteller':
-            user_has_story_teller_role = True
-            break
-    return user_has_story_teller_role
+def is_bot_created(channel: discord.abc.GuildChannel) -> bool:
+    return any(target.name == 'BotC-bot' for target in channel.overwrites)
 
 async def response(interaction: discord.Interaction, message: str):
-    await interaction.response.send_message(message, ephemeral=True, delete_after=10)
\ No newline at end of file
+    await interaction.response.send_message(message, ephemeral=True, delete_after=10)
+
+def throttled_progress(interaction: discord.Interaction, render: Callable[[int, int], str]) -> ProgressCallback:
+    # Shows progress in the original response, at most one edit per VIEW_EDIT_INTERVAL
+    last_edit = time.monotonic()
+
+    async def report_progress(done: int, total: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < VIEW_EDIT_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        await interaction.edit_original_response(content=render(done, total))
+
+    return report_progress
+
+def command_fingerprint(tree: discord.app_commands.CommandTree) -> str:
+    commands = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command["name"])
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()